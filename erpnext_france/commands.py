@@ -0,0 +1,60 @@
+# Copyright (c) 2024, Scopen and contributors
+# For license information, please see license.txt
+
+import click
+from frappe.commands import get_site, pass_context
+
+
+@click.command("backfill-accounting-entry-numbers")
+@click.argument("company")
+@click.option("--from-date", help="Posting date of the first GL Entries to backfill")
+@click.option("--to-date", help="Posting date of the last GL Entries to backfill")
+@click.option("--chunk-size", type=int, default=1000, help="Vouchers committed together")
+@pass_context
+def backfill_accounting_entry_numbers(context, company, from_date=None, to_date=None, chunk_size=1000):
+	"""Fill the missing accounting entry numbers and journals of the GL Entries of a company"""
+	import frappe
+
+	from erpnext_france.utils.accounting_entry_number import backfill_accounting_entry_numbers
+
+	def echo_progress(result):
+		click.echo(
+			"{0} vouchers backfilled in {1}s ({2} vouchers/s)".format(
+				result.vouchers, result.duration, round(result.vouchers / (result.duration or 1))
+			)
+		)
+
+	frappe.init(site=get_site(context))
+	frappe.connect()
+	try:
+		result = backfill_accounting_entry_numbers(
+			company, from_date, to_date, chunk_size, progress=echo_progress
+		)
+		click.echo(
+			"{0} vouchers backfilled in {1}s, {2} left without journal".format(
+				result.vouchers, result.duration, result.without_journal
+			)
+		)
+	finally:
+		frappe.destroy()
+
+
+
+@click.command("rebuild-balance-snapshots")
+@click.option("--company", help="Company of the snapshots to rebuild, all companies by default")
+@pass_context
+def rebuild_balance_snapshots(context, company=None):
+	"""Rebuild the monthly account balance snapshots from the GL Entries"""
+	import frappe
+
+	from erpnext_france.utils.balance_snapshot import rebuild_balance_snapshots
+
+	frappe.init(site=get_site(context))
+	frappe.connect()
+	try:
+		rebuild_balance_snapshots(company)
+	finally:
+		frappe.destroy()
+
+
+commands = [backfill_accounting_entry_numbers, rebuild_balance_snapshots]
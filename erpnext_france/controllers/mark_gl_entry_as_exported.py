@@ -1,17 +1,108 @@
 import frappe
 from frappe import _
 import json
+import time
+from frappe.utils import getdate
 from frappe.utils.data import get_datetime
 
+from erpnext_france.utils.fec import CHUNK_SIZE, apply_export_filters, set_export_date
+
+REPORT_READ_AT_EXPIRY = 24 * 60 * 60
+
+
 @frappe.whitelist()
 def mark_gl_entry_as_exported(gl_entries):
     gl_entries = json.loads(gl_entries)
     date = get_datetime()
 
-    for [gl_entry_name, export_date] in gl_entries:
-        if not export_date:
-            frappe.db.set_value('GL Entry', gl_entry_name, 'export_date', date, update_modified=False)
+    gl_entries = [gl_entry_name for [gl_entry_name, export_date] in gl_entries if not export_date]
+    for i in range(0, len(gl_entries), CHUNK_SIZE):
+        set_export_date(gl_entries[i:i + CHUNK_SIZE], date)
 
     return {
         'message': 'ok'
     }
+
+
+def get_report_read_at_key(company, fiscal_year, from_date, to_date):
+    return 'fec_report_read_at::{0}::{1}::{2}::{3}'.format(
+        company, fiscal_year, getdate(from_date) if from_date else '', getdate(to_date) if to_date else ''
+    )
+
+
+def set_report_read_at(company, fiscal_year, from_date, to_date, read_at):
+    """Keep the time the FEC report of the user read the GL Entries of these filters"""
+    frappe.cache().set_value(
+        get_report_read_at_key(company, fiscal_year, from_date, to_date),
+        read_at,
+        user=frappe.session.user,
+        expires_in_sec=REPORT_READ_AT_EXPIRY,
+    )
+
+
+def get_report_read_at(company, fiscal_year, from_date, to_date):
+    return frappe.cache().get_value(
+        get_report_read_at_key(company, fiscal_year, from_date, to_date), user=frappe.session.user
+    )
+
+
+@frappe.whitelist()
+def mark_gl_entries_as_exported(
+    company=None, fiscal_year=None, from_date=None, to_date=None, fec_export=None
+):
+    """
+    Stamp the export date of the not exported GL Entries of the FEC report, or of an FEC Export
+
+    Only the entries created before the exported data was read on the server are stamped:
+    the time the report of the user ran with these filters, or the time each chunk of the
+    FEC Export was read. Entries posted afterwards are left for the next export.
+    """
+    frappe.has_permission('GL Entry', 'export', throw=True)
+    start = time.monotonic()
+
+    if fec_export:
+        fec_export = frappe.get_doc('FEC Export', fec_export)
+        company, fiscal_year = fec_export.company, fec_export.fiscal_year
+        periods = [
+            (chunk.from_date, chunk.to_date, chunk.read_at)
+            for chunk in fec_export.chunks
+            if chunk.status == 'Completed'
+        ]
+    else:
+        periods = [(from_date, to_date, get_report_read_at(company, fiscal_year, from_date, to_date))]
+
+    if not company or not fiscal_year:
+        frappe.throw(_('{0} and {1} are mandatory').format(_('Company'), _('Fiscal Year')))
+
+    if not periods or not all(read_at for from_date, to_date, read_at in periods):
+        frappe.throw(_('The exported GL Entries must be read again before being marked as exported'))
+
+    year_start_date, year_end_date = frappe.db.get_value(
+        'Fiscal Year', fiscal_year, ['year_start_date', 'year_end_date']
+    )
+
+    gle = frappe.qb.DocType('GL Entry')
+    date = get_datetime()
+    count = 0
+    for from_date, to_date, read_at in periods:
+        # Stamped entries leave the selection, so each chunk is the next one
+        query = apply_export_filters(
+            frappe.qb.from_(gle).select(gle.name),
+            gle,
+            company,
+            fiscal_year,
+            getdate(from_date or year_start_date),
+            getdate(to_date or year_end_date),
+            True,
+        ).where(gle.creation <= get_datetime(read_at)).limit(CHUNK_SIZE)
+
+        while gl_entries := query.run(pluck=True):
+            set_export_date(gl_entries, date)
+            count += len(gl_entries)
+
+    return {
+        'message': 'ok',
+        'count': count,
+        'export_date': date,
+        'duration': round(time.monotonic() - start, 3),
+    }
@@ -0,0 +1,128 @@
+# Copyright (c) 2024, Scopen and Contributors
+# See license.txt
+
+from unittest.mock import patch
+
+import frappe
+from erpnext.accounts.doctype.sales_invoice.test_sales_invoice import create_sales_invoice
+from frappe.query_builder.functions import Sum
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import add_months, flt, get_first_day, getdate, nowdate
+
+from erpnext_france.erpnext_france.report.general_ledger.general_ledger import get_opening_balance
+from erpnext_france.utils.balance_snapshot import (
+	get_snapshots_horizon,
+	rebuild_balance_snapshots,
+	write_pending_horizons,
+)
+
+COMPANY = "_Test Company"
+ACCOUNT = "Debtors - _TC"
+
+
+class TestAccountBalanceSnapshot(FrappeTestCase):
+	def setUp(self):
+		# The rebuild commits: the snapshots and the horizon are rolled back with the test instead
+		commit = patch.object(frappe.db, "commit")
+		commit.start()
+		self.addCleanup(commit.stop)
+
+		rebuild_balance_snapshots(COMPANY)
+		self.posting_date = get_first_day(add_months(nowdate(), -3))
+		self.from_date = get_first_day(add_months(self.posting_date, 1))
+
+	def get_ledger_balance(self):
+		gle = frappe.qb.DocType("GL Entry")
+		return flt(
+			(
+				frappe.qb.from_(gle)
+				.select(Sum(gle.debit) - Sum(gle.credit))
+				.where(gle.company == COMPANY)
+				.where(gle.account == ACCOUNT)
+				.where(gle.is_cancelled == 0)
+				.where((gle.posting_date < self.from_date) | (gle.is_opening == "Yes"))
+			).run()[0][0]
+		)
+
+	def get_snapshot_totals(self):
+		"""Return the {month: balance} of the snapshots and of the GL Entries of the account"""
+		snapshot = frappe.qb.DocType("Account Balance Snapshot")
+		gle = frappe.qb.DocType("GL Entry")
+		snapshots = (
+			frappe.qb.from_(snapshot)
+			.select(snapshot.month, Sum(snapshot.debit) - Sum(snapshot.credit))
+			.where(snapshot.company == COMPANY)
+			.where(snapshot.account == ACCOUNT)
+			.where(snapshot.month < get_snapshots_horizon(COMPANY))
+			.groupby(snapshot.month)
+		).run()
+		ledger = (
+			frappe.qb.from_(gle)
+			.select(gle.posting_date, gle.debit - gle.credit)
+			.where(gle.company == COMPANY)
+			.where(gle.account == ACCOUNT)
+			.where(gle.is_cancelled == 0)
+			.where(gle.posting_date < get_snapshots_horizon(COMPANY))
+		).run()
+
+		ledger_totals = {}
+		for posting_date, balance in ledger:
+			month = get_first_day(posting_date)
+			ledger_totals[month] = flt(ledger_totals.get(month)) + flt(balance)
+
+		return (
+			{getdate(month): flt(balance, 2) for month, balance in snapshots if flt(balance, 2)},
+			{month: flt(balance, 2) for month, balance in ledger_totals.items() if flt(balance, 2)},
+		)
+
+	def get_opening_balance(self):
+		filters = frappe._dict(
+			company=COMPANY, account=[ACCOUNT], from_date=self.from_date, to_date=self.from_date
+		)
+		return get_opening_balance(filters, frappe.qb.DocType("GL Entry"))
+
+	def assertSnapshotsMatchLedger(self):
+		self.assertEqual(flt(self.get_opening_balance(), 2), flt(self.get_ledger_balance(), 2))
+
+		rebuild_balance_snapshots(COMPANY)
+		self.assertEqual(flt(self.get_opening_balance(), 2), flt(self.get_ledger_balance(), 2))
+		snapshot_totals, ledger_totals = self.get_snapshot_totals()
+		self.assertEqual(snapshot_totals, ledger_totals)
+
+	def test_rebuild(self):
+		self.assertEqual(get_snapshots_horizon(COMPANY), get_first_day(add_months(nowdate(), -1)))
+		snapshot_totals, ledger_totals = self.get_snapshot_totals()
+		self.assertEqual(snapshot_totals, ledger_totals)
+
+	def test_current_month_keeps_horizon(self):
+		horizon = get_snapshots_horizon(COMPANY)
+		create_sales_invoice(company=COMPANY, debit_to=ACCOUNT)
+		write_pending_horizons()
+		self.assertEqual(get_snapshots_horizon(COMPANY), horizon)
+
+	def test_snapshots_after_cancel(self):
+		si = create_sales_invoice(company=COMPANY, debit_to=ACCOUNT, posting_date=self.posting_date)
+		write_pending_horizons()
+		self.assertEqual(get_snapshots_horizon(COMPANY), self.posting_date)
+		self.assertSnapshotsMatchLedger()
+
+		si.reload()
+		si.cancel()
+		write_pending_horizons()
+		self.assertEqual(get_snapshots_horizon(COMPANY), self.posting_date)
+		self.assertSnapshotsMatchLedger()
+
+	def test_snapshots_after_repost(self):
+		si = create_sales_invoice(company=COMPANY, debit_to=ACCOUNT, posting_date=self.posting_date)
+		rebuild_balance_snapshots(COMPANY)
+
+		# A repost deletes the ledger entries of the voucher, then posts them again
+		for doctype in ("GL Entry", "Payment Ledger Entry"):
+			ledger = frappe.qb.DocType(doctype)
+			frappe.qb.from_(ledger).delete().where(ledger.voucher_no == si.name).run()
+		si.reload()
+		si.make_gl_entries(from_repost=True)
+		write_pending_horizons()
+
+		self.assertEqual(get_snapshots_horizon(COMPANY), self.posting_date)
+		self.assertSnapshotsMatchLedger()
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021, Britlog and Contributors
+# Copyright (c) 20212023, Scopen and Contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe import _
+from frappe.utils import format_datetime
+
+
+def get_export_format(exporter):
+	"""
+	Return the format of the company export file format, from the `accounting_export_formats`
+	hook, so that other apps can add their formats
+	"""
+	export_formats = frappe.get_hooks("accounting_export_formats")
+	if exporter.file_format not in export_formats:
+		return
+
+	return frappe.get_attr(export_formats[exporter.file_format][-1])(exporter)
+
+
+@frappe.whitelist()
+def get_export_format_names():
+	return list(frappe.get_hooks("accounting_export_formats"))
+
+
+def validate_export_file_format(doc, method=None):
+	"""Check the export file format of the Company against the registered formats"""
+	if doc.export_file_format and doc.export_file_format not in get_export_format_names():
+		frappe.throw(
+			_("{0} is not a registered export file format").format(frappe.bold(doc.export_file_format))
+		)
+
+
+def quote_field(value):
+	"""Quote a SAGE field like the csv module does, when it contains a separator or a quote"""
+	value = '' if value is None else str(value)
+	if any(char in value for char in (';', '"', '\r', '\n')):
+		return '"{}"'.format(value.replace('"', '""'))
+
+	return value
+
+
+class ExportFormat:
+	"""Format of an accounting export file, encoding each GL Entry as one line"""
+
+	file_name = "EXPORT.TXT"
+	encoding = "utf-8"
+	line_terminator = "\r\n"
+
+	def __init__(self, exporter):
+		self.exporter = exporter
+
+	def prepare(self):
+		"""Load what the rows need before the GL Entries cursor is opened"""
+		pass
+
+	def format_row(self, doc):
+		raise NotImplementedError
+
+	def encode_row(self, doc):
+		return (self.format_row(doc) + self.line_terminator).encode(self.encoding)
+
+
+class CielFormat(ExportFormat):
+	file_name = "XIMPORT.TXT"
+
+	def format_row(self, doc):
+		ecriture_num = '{:>5s}'.format(doc.get("name")[-5:])
+		journal_code = '{:<2s}'.format(self.exporter.journal_code)
+		ecriture_date = format_datetime(doc.get("posting_date"), "yyyyMMdd")
+
+		if doc.get("against_voucher_type") == "Purchase Invoice":
+			echeance_date = format_datetime(doc.get("due_date"), "yyyyMMdd") or ''
+		elif doc.get("against_voucher_type") == "Sales Invoice":
+			echeance_date = format_datetime(doc.get("due_date"), "yyyyMMdd") or ''
+		else:
+			echeance_date = '{:<8s}'.format("")
+
+		piece_num = '{:<12s}'.format(doc.get("voucher_no"))
+
+		if doc.get("party_type") == "Supplier":
+			compte_num = '{}{:<8s}'.format("401", doc.get("subledger_account") or '')
+		elif doc.get("party_type") == "Customer":
+			compte_num = '{}{:<8s}'.format("411", doc.get("subledger_account") or '')
+		else:
+			compte_num = '{:<11s}'.format(doc.get("account_number") or '')
+
+		libelle = '{}{:<17s}'.format("FACTURE ", doc.get("voucher_no")[:17])
+		montant = '{:>13.2f}'.format(doc.get("debit")) if doc.get("debit") != 0 \
+			else '{:>13.2f}'.format(doc.get("credit"))
+		credit_debit = "D" if doc.get("debit") > 0 else "C"
+		numero_pointage = piece_num
+		code_analytic = '{:<6s}'.format("")
+
+		if doc.get("party_type") in ("Supplier", "Customer"):
+			libelle_compte = '{:<34s}'.format(doc.get("party") or '')[:34]
+		else:
+			libelle_compte = '{:<34s}'.format(doc.get("account_name") or '')[:34]
+
+		euro = "O"
+
+		row = [ecriture_num, journal_code, ecriture_date, echeance_date, piece_num, compte_num,
+			   libelle, montant, credit_debit, numero_pointage, code_analytic, libelle_compte, euro]
+
+		return ''.join(row)
+
+
+class SageFormat(ExportFormat):
+	file_name = "EXPORT.TXT"
+
+	def format_row(self, doc):
+		doc.invoice_number = doc.orign_no or doc.voucher_no
+		doc.party = doc.party_name or doc.party
+		journal_code = self.exporter.journal_code
+		ecriture_date = format_datetime(doc.get("posting_date"), "ddMMyy")
+
+		if doc.get("against_voucher_type") == "Purchase Invoice":
+			echeance_date = format_datetime(doc.get("due_date"), "ddMMyy")
+		elif doc.get("against_voucher_type") == "Sales Invoice":
+			echeance_date = format_datetime(doc.get("due_date"), "ddMMyy")
+		else:
+			echeance_date = ''
+
+		piece_num = '{:.17s}'.format(doc.get("invoice_number").replace("\n", " ").replace("\r", " "))
+		compte_num = doc.get("account_number")
+		ref_inv = '{:.13s}'.format(doc.get("voucher_no"))
+		ref_inv_inv = ref_inv
+		compte_num_aux = ''
+		if doc.get("party_type") in ("Supplier", "Customer"):
+			compte_num_aux = format(doc.get("subledger_account") or '')
+
+		libelle = '{}{:.49s}'.format("FACT ", doc.get("party"))
+		debit = '{:.2f}'.format(doc.get("debit")).replace(".", ",")
+		credit = '{:.2f}'.format(doc.get("credit")).replace(".", ",")
+
+		if doc.get("party_type") in ("Supplier", "Customer"):
+			libelle_compte = '{:.17s}'.format(format(doc.get("party") or ''));
+		else:
+			libelle_compte = '{:.17s}'.format(format(doc.get("account_name") or ''));
+
+		if doc.get("against_voucher_type") == "Purchase Invoice":
+			ref_inv_inv = piece_num
+			piece_num = ref_inv
+
+		row = [journal_code,
+			   ecriture_date,
+			   compte_num,
+			   ref_inv,
+			   ref_inv_inv,
+			   piece_num,
+			   compte_num_aux,
+			   libelle,
+			   debit,
+			   credit,
+			   echeance_date]
+
+		return ';'.join(quote_field(value) for value in row)
@@ -6,21 +6,34 @@ import frappe
 from frappe import _
 from frappe.email.doctype.notification.notification import get_context
 from frappe.model.document import Document
-import copy
+from frappe.utils import now
 
-from erpnext_france.utils.accounting_entry_number import get_accounting_number
+from erpnext_france.utils.accounting_entry_number import (
+	clear_journal_rules_cache,
+	evaluate_condition,
+	get_accounting_numbers,
+	get_journal_rules,
+)
+from erpnext_france.utils.balance_snapshot import invalidate_snapshots
+from erpnext.accounts.doctype.gl_entry.gl_entry import update_outstanding_amt
 from erpnext.accounts.general_ledger import (
-	make_entry,
 	check_freezing_date,
-	set_as_cancel,
 	validate_accounting_period,
 )
 
+ADJUSTMENT_CHUNK_SIZE = 100
+
 class AccountingJournal(Document):
 	def validate(self):
 		if self.conditions:
 			self.validate_conditions()
 
+	def on_update(self):
+		clear_journal_rules_cache()
+
+	def on_trash(self):
+		clear_journal_rules_cache()
+
 	def validate_conditions(self):
 		for condition in self.conditions:
 			if condition.condition:
@@ -52,114 +65,220 @@ def get_entries(doctype, docnames):
 	)
 
 
-# @dokos
 @frappe.whitelist()
-def accounting_journal_adjustment(doctype, docnames, accounting_journal):
-	for docname in frappe.parse_json(docnames):
-		original_entries = frappe.get_all(
-			"GL Entry",
-			fields=["*"],
-			filters={"voucher_type": doctype, "voucher_no": docname, "is_cancelled": 0},
-		)
+def enqueue_accounting_journal_adjustment(doctype, docnames, accounting_journal):
+	check_adjustment_permission(doctype)
+	frappe.enqueue(
+		adjust_accounting_journals,
+		queue="long",
+		timeout=14400,
+		enqueue_after_commit=True,
+		doctype=doctype,
+		docnames=frappe.parse_json(docnames),
+		accounting_journal=accounting_journal,
+	)
 
-		make_reverse_gl_entries_without_cancelling(voucher_type=doctype, voucher_no=docname)
 
-		for gl_entry in original_entries:
-			gl_entry["name"] = None
-			gl_entry["accounting_journal"] = accounting_journal
-			make_entry(gl_entry, False, "No")
+def check_adjustment_permission(doctype):
+	frappe.only_for("Accounts Manager")
+	frappe.has_permission(doctype, "submit", throw=True)
 
 
-@frappe.whitelist()
-def get_accounting_journal(doc):
-	doc = frappe.parse_json(doc)
+def adjust_accounting_journals(doctype, docnames, accounting_journal):
+	"""
+	Adjust the journal of the documents by chunks, each committed, publishing the progress
 
-	applicable_rules = []
-	query_filters = {
-		"company": doc.get("company"),
-		"disabled": 0,
-		"document_type": doc.get("doctype"),
-	}
+	A failed chunk is rolled back and logged, and the adjustment stops there: the documents of
+	the previous chunks stay adjusted, and the failure is published with their count.
+	"""
+	processed = 0
+	for i in range(0, len(docnames), ADJUSTMENT_CHUNK_SIZE):
+		try:
+			accounting_journal_adjustment(
+				doctype, docnames[i : i + ADJUSTMENT_CHUNK_SIZE], accounting_journal
+			)
+			frappe.db.commit()
+		except Exception:
+			frappe.db.rollback()
+			frappe.log_error(title=_("Accounting Journal Adjustment failed"))
+			frappe.publish_realtime(
+				"accounting_journal_adjustment",
+				{"doctype": doctype, "docnames": docnames, "adjusted": processed, "failed": True},
+				user=frappe.session.user,
+			)
+			return
 
-	if doc.get("doctype") == "Payment Entry":
-		query_filters["account"] = (
-			doc.get("paid_to") if doc.get("payment_type") == "Receive" else doc.get("paid_from")
+		processed = min(i + ADJUSTMENT_CHUNK_SIZE, len(docnames))
+		frappe.publish_progress(
+			processed * 100 / len(docnames),
+			title=_("Accounting Journal Adjustment"),
+			description=_("{0} of {1} documents adjusted").format(processed, len(docnames)),
 		)
 
-	applicable_rules = frappe.get_all(
-		"Accounting Journal",
-		filters=query_filters,
-		fields=[
-			"name",
-			"type",
-			"account",
-			"`tabAccounting Journal Rule`.document_type",
-			"`tabAccounting Journal Rule`.condition",
-		],
+	frappe.publish_realtime(
+		"accounting_journal_adjustment",
+		{"doctype": doctype, "docnames": docnames, "adjusted": processed},
+		user=frappe.session.user,
 	)
 
-	for condition in [rule for rule in applicable_rules if rule.condition]:
-		if frappe.safe_eval(
-			condition.condition,
-			None,
-			{"doc": doc},
-		):
-			return condition.name
 
-	if [rule for rule in applicable_rules if not rule.condition]:
-		return [rule for rule in applicable_rules if not rule.condition][0].name
-
-	return None
-
-def make_reverse_gl_entries_without_cancelling(
-	voucher_type=None,
-	voucher_no=None,
-):
+# @dokos
+@frappe.whitelist()
+def accounting_journal_adjustment(doctype, docnames, accounting_journal):
 	"""
-	Get original gl entries of the voucher
-	and make reverse gl entries by swapping debit and credit
+	Reverse the GL Entries of the documents and post them again in the accounting journal,
+	with one multi-row insert and one accounting entry number per reversed document
 	"""
-
-	gl_entry = frappe.qb.DocType("GL Entry")
+	check_adjustment_permission(doctype)
+	gle = frappe.qb.DocType("GL Entry")
 	gl_entries = (
-		frappe.qb.from_(gl_entry)
+		frappe.qb.from_(gle)
 		.select("*")
-		.where(gl_entry.voucher_type == voucher_type)
-		.where(gl_entry.voucher_no == voucher_no)
-		.where(gl_entry.is_cancelled == 0)
+		.where(gle.voucher_type == doctype)
+		.where(gle.voucher_no.isin(frappe.parse_json(docnames)))
+		.where(gle.is_cancelled == 0)
+		.orderby(gle.voucher_no)
+		.orderby(gle.creation)
 		.for_update()
 	).run(as_dict=1)
 
 	if not gl_entries:
 		return
 
-	validate_accounting_period(gl_entries)
-	check_freezing_date(gl_entries[0]["posting_date"], False)
-	set_as_cancel(gl_entries[0]["voucher_type"], gl_entries[0]["voucher_no"])
+	entries_by_voucher = {}
+	for gl_entry in gl_entries:
+		entries_by_voucher.setdefault(gl_entry.voucher_no, []).append(gl_entry)
+
+	vouchers_by_fiscal_year = {}
+	for voucher_entries in entries_by_voucher.values():
+		validate_accounting_period(voucher_entries)
+		check_freezing_date(voucher_entries[0].posting_date, False)
+		vouchers_by_fiscal_year.setdefault(voucher_entries[0].fiscal_year, []).append(voucher_entries)
 
-	accounting_number = get_accounting_number(gl_entries[0])
-	for entry in gl_entries:
-		new_gle = copy.deepcopy(entry)
-		new_gle["name"] = None
-		new_gle["accounting_entry_number"] = accounting_number
-		debit = new_gle.get("debit", 0)
-		credit = new_gle.get("credit", 0)
+	(
+		frappe.qb.update(gle)
+		.set(gle.is_cancelled, 1)
+		.set(gle.modified, now())
+		.set(gle.modified_by, frappe.session.user)
+		.where(gle.voucher_type == doctype)
+		.where(gle.voucher_no.isin(list(entries_by_voucher)))
+		.where(gle.is_cancelled == 0)
+	).run()
 
-		debit_in_account_currency = new_gle.get("debit_in_account_currency", 0)
-		credit_in_account_currency = new_gle.get("credit_in_account_currency", 0)
+	new_gl_entries = []
+	for fiscal_year, vouchers in sorted(vouchers_by_fiscal_year.items()):
+		accounting_numbers = get_accounting_numbers(fiscal_year, len(vouchers))
+		for voucher_entries, accounting_number in zip(vouchers, accounting_numbers):
+			new_gl_entries.extend(
+				get_voucher_adjustment_entries(voucher_entries, accounting_number, accounting_journal)
+			)
 
-		new_gle["debit"] = credit
-		new_gle["credit"] = debit
-		new_gle["debit_in_account_currency"] = credit_in_account_currency
-		new_gle["credit_in_account_currency"] = debit_in_account_currency
+	insert_gl_entries(new_gl_entries)
+	update_against_vouchers_outstanding(new_gl_entries)
 
-		if not new_gle["remarks"]:
-			new_gle["remarks"] = _("On cancellation of ") + new_gle["voucher_no"]
 
-		new_gle["is_cancelled"] = 1
+def get_voucher_adjustment_entries(voucher_entries, accounting_number, accounting_journal):
+	"""
+	Return the reversal and the replacement of the GL Entries of a voucher, built in one pass
+
+	The reversal is one accounting entry, so it is posted in the journal of the voucher, resolved
+	once from its GL Entries, or in `accounting_journal` with the replacement when it has none.
+	"""
+	reversal_journal = next(
+		(gl_entry.accounting_journal for gl_entry in voucher_entries if gl_entry.accounting_journal),
+		accounting_journal,
+	)
 
-		if not new_gle.get("accounting_journal"):
-			get_accounting_journal(new_gle)
+	reversal, replacement = [], []
+	for gl_entry in voucher_entries:
+		if gl_entry.debit or gl_entry.credit:
+			reversal.append(get_reverse_gl_entry(gl_entry, accounting_number, reversal_journal))
+		replacement.append(frappe._dict(gl_entry, accounting_journal=accounting_journal))
 
-		if new_gle["debit"] or new_gle["credit"]:
-			make_entry(new_gle, False, "Yes")
+	return reversal + replacement
+
+
+def get_reverse_gl_entry(gl_entry, accounting_number, accounting_journal):
+	"""Return a cancelled copy of the GL Entry in the accounting journal, with swapped debit and credit"""
+	reverse_gl_entry = frappe._dict(
+		gl_entry,
+		accounting_entry_number=accounting_number,
+		accounting_journal=accounting_journal,
+		debit=gl_entry.credit,
+		credit=gl_entry.debit,
+		debit_in_account_currency=gl_entry.credit_in_account_currency,
+		credit_in_account_currency=gl_entry.debit_in_account_currency,
+		remarks=gl_entry.remarks or _("On cancellation of ") + gl_entry.voucher_no,
+		is_cancelled=1,
+	)
+	if "debit_in_transaction_currency" in gl_entry:
+		reverse_gl_entry.debit_in_transaction_currency = gl_entry.credit_in_transaction_currency
+		reverse_gl_entry.credit_in_transaction_currency = gl_entry.debit_in_transaction_currency
+
+	return reverse_gl_entry
+
+
+def insert_gl_entries(gl_entries):
+	"""
+	Insert submitted GL Entries with one multi-row insert, without the GL Entry controller
+
+	The rows are the reversal and the replacement of validated GL Entries, on the same accounts,
+	dimensions and amounts, so the account and dimension checks of the GL Entry still hold. The
+	caller runs the checks that depend on the time of posting, `validate_accounting_period` and
+	`check_freezing_date` for each voucher, and sets the accounting entry numbers that the
+	`before_submit` hook would allocate: new ones for the reversals, while the replacements
+	keep the number of the entry they replace.
+	"""
+	if not gl_entries:
+		return
+
+	timestamp = now()
+	for gl_entry in gl_entries:
+		gl_entry.update(
+			name=frappe.generate_hash(length=10),
+			creation=timestamp,
+			modified=timestamp,
+			owner=frappe.session.user,
+			modified_by=frappe.session.user,
+			docstatus=1,
+		)
+
+	fields = list(gl_entries[0])
+	frappe.db.bulk_insert(
+		"GL Entry", fields, [[gl_entry.get(field) for field in fields] for gl_entry in gl_entries]
+	)
+	invalidate_snapshots(gl_entries)
+
+
+@frappe.whitelist()
+def get_accounting_journal(doc):
+	doc = frappe.parse_json(doc)
+
+	applicable_rules = [
+		rule for rule in get_journal_rules(doc.get("company")) if rule.document_type == doc.get("doctype")
+	]
+
+	if doc.get("doctype") == "Payment Entry":
+		account = doc.get("paid_to") if doc.get("payment_type") == "Receive" else doc.get("paid_from")
+		applicable_rules = [rule for rule in applicable_rules if (rule.account or None) == (account or None)]
+
+	for condition in [rule for rule in applicable_rules if rule.condition]:
+		if evaluate_condition(condition.condition, doc):
+			return condition.name
+
+	if [rule for rule in applicable_rules if not rule.condition]:
+		return [rule for rule in applicable_rules if not rule.condition][0].name
+
+	return None
+
+
+def update_against_vouchers_outstanding(gl_entries):
+	"""Update the outstanding amount of the vouchers the GL Entries are against, once per voucher"""
+	against_vouchers = {
+		(gl_entry.account, gl_entry.party_type, gl_entry.party, gl_entry.against_voucher_type, gl_entry.against_voucher)
+		for gl_entry in gl_entries
+		if gl_entry.against_voucher
+		and gl_entry.against_voucher_type in ("Journal Entry", "Sales Invoice", "Purchase Invoice", "Fees")
+	}
+	for against_voucher in against_vouchers:
+		update_outstanding_amt(*against_voucher)
@@ -0,0 +1,26 @@
+// Copyright (c) 2024, Scopen and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on("FEC Export", {
+	refresh(frm) {
+		if (frm.is_new() || frm.doc.__onload?.is_running) {
+			return;
+		}
+
+		const label = ["Failed", "Queued", "In Progress"].includes(frm.doc.status)
+			? __("Resume Export")
+			: __("Generate FEC File");
+		frm.add_custom_button(label, () => {
+			frm.call("enqueue_export").then(() => {
+				frappe.show_alert({message: __("FEC export queued"), indicator: "green"});
+				frm.reload_doc();
+			});
+		});
+
+		if (frm.doc.fec_file) {
+			frm.add_custom_button(__("Download"), () => {
+				window.open(frm.doc.fec_file);
+			});
+		}
+	}
+});
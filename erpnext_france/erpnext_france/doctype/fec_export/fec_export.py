@@ -0,0 +1,262 @@
+# Copyright (c) 2024, Scopen and contributors
+# For license information, please see license.txt
+
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+
+import frappe
+from frappe import _
+from frappe.model.document import Document
+from frappe.utils import cint, getdate, now_datetime
+from frappe.utils.background_jobs import is_job_enqueued
+
+from erpnext_france.utils.fec import (
+	FEC_FIELDS,
+	FEC_SEPARATOR,
+	attach_fec_file,
+	count_fec_lines,
+	get_fec_file_name,
+	get_fec_file_path,
+	get_month_partitions,
+	iter_fec_rows,
+	iter_unexported_fec_rows,
+	write_fec_lines,
+)
+
+
+class FECExport(Document):
+	def validate(self):
+		if self.mark_as_exported:
+			self.hide_already_exported = 1
+
+		self.set_dates()
+		self.set_chunks()
+
+	def set_dates(self):
+		if not self.fiscal_year:
+			return
+
+		fiscal_year_dates = frappe.db.get_value(
+			"Fiscal Year", self.fiscal_year, ["year_start_date", "year_end_date"]
+		)
+		if not fiscal_year_dates:
+			frappe.throw(_("Fiscal Year {0} does not exist").format(self.fiscal_year))
+
+		year_start_date, year_end_date = fiscal_year_dates
+		self.from_date = self.from_date or year_start_date
+		self.to_date = self.to_date or year_end_date
+
+		if getdate(self.from_date) > getdate(self.to_date):
+			frappe.throw(_("From Date must be before To Date"))
+
+	def set_chunks(self):
+		if self.mark_as_exported or not (self.from_date and self.to_date):
+			self.chunks = []
+			return
+
+		if any(chunk.status == "Completed" for chunk in self.chunks):
+			return
+
+		self.chunks = []
+		for from_date, to_date in get_month_partitions(self.from_date, self.to_date):
+			self.append("chunks", {"from_date": from_date, "to_date": to_date})
+
+	def onload(self):
+		self.set_onload("is_running", self.is_running())
+
+	def is_running(self):
+		"""An export left Queued or In Progress by a killed job can be resumed"""
+		return self.status in ("Queued", "In Progress") and is_job_enqueued(self.get_job_id())
+
+	def get_job_id(self):
+		return "fec_export::{0}".format(self.name)
+
+	@frappe.whitelist()
+	def enqueue_export(self):
+		if self.is_running():
+			frappe.throw(_("This export is already running"))
+
+		self.db_set("status", "Queued")
+		frappe.enqueue(
+			generate_fec_file,
+			queue="long",
+			timeout=14400,
+			job_id=self.get_job_id(),
+			enqueue_after_commit=True,
+			fec_export=self.name,
+		)
+
+	def generate(self):
+		"""Format the pending chunks, then merge them in the FEC file"""
+		self.db_set({"status": "In Progress", "error_log": None})
+		if not self.total_rows:
+			self.db_set("total_rows", count_fec_lines(*self.get_export_args()))
+		frappe.db.commit()
+
+		try:
+			if self.mark_as_exported:
+				self.write_unexported_entries()
+			else:
+				self.write_pending_chunks()
+				self.merge_chunks()
+			self.db_set("status", "Completed")
+		except Exception:
+			frappe.db.rollback()
+			self.db_set({"status": "Failed", "error_log": frappe.get_traceback()})
+			frappe.db.commit()
+			raise
+
+	def write_pending_chunks(self):
+		"""Format the pending chunks concurrently, each in a process with its own connection"""
+		pending_chunks = self.get_pending_chunks()
+		if not pending_chunks:
+			return
+
+		os.makedirs(self.get_chunks_path(), exist_ok=True)
+		workers = min(cint(frappe.conf.fec_export_workers) or os.cpu_count() or 1, len(pending_chunks))
+
+		errors = []
+		with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn")) as executor:
+			futures = {
+				executor.submit(
+					write_chunk_file, frappe.local.site, frappe.local.sites_path, self.name, chunk.name
+				): chunk
+				for chunk in pending_chunks
+			}
+			for future in as_completed(futures):
+				try:
+					rows_count, read_at = future.result()
+				except Exception as e:
+					errors.append(e)
+					continue
+
+				# Completed chunks are kept so that a failed export resumes from them
+				self.complete_chunk(futures[future], rows_count, read_at)
+
+		if errors:
+			raise errors[0]
+
+	def complete_chunk(self, chunk, rows_count, read_at):
+		chunk.db_set({"status": "Completed", "rows": rows_count, "read_at": read_at})
+		processed_rows = sum(c.rows for c in self.chunks if c.status == "Completed")
+		self.db_set("processed_rows", processed_rows)
+		frappe.db.commit()
+		self.publish_progress(processed_rows)
+
+	def get_export_args(self):
+		return (
+			self.company,
+			self.fiscal_year,
+			getdate(self.from_date),
+			getdate(self.to_date),
+			self.hide_already_exported,
+		)
+
+	def get_chunks_path(self):
+		return frappe.get_site_path("private", "fec_export", self.name)
+
+	def get_chunk_path(self, chunk):
+		return os.path.join(self.get_chunks_path(), "{0}.txt".format(chunk.idx))
+
+	def get_pending_chunks(self):
+		return [
+			chunk
+			for chunk in self.chunks
+			if chunk.status != "Completed" or not os.path.exists(self.get_chunk_path(chunk))
+		]
+
+	def write_chunk(self, chunk):
+		"""Write the FEC lines of a chunk, and return their count and the time they were read"""
+		read_at = now_datetime()
+		rows_count = 0
+		with open(self.get_chunk_path(chunk), "w", encoding="utf-8", newline="") as chunk_file:
+			for rows in iter_fec_rows(
+				*self.get_export_args(), partition=(getdate(chunk.from_date), getdate(chunk.to_date))
+			):
+				write_fec_lines(chunk_file, rows)
+				rows_count += len(rows)
+
+		return rows_count, read_at
+
+	def publish_progress(self, processed_rows):
+		frappe.publish_progress(
+			processed_rows * 100 / (self.total_rows or 1),
+			title=_("FEC Export"),
+			doctype=self.doctype,
+			docname=self.name,
+			description=_("{0} of {1} rows processed").format(processed_rows, self.total_rows),
+		)
+
+	def write_unexported_entries(self):
+		"""
+		Write the entries not exported yet and stamp their export date
+
+		This runs in the job process only, as the file and the export dates are committed
+		together: a failed export is started again from the entries still not exported.
+		"""
+		file_name = get_fec_file_name(self.company, self.fiscal_year)
+		path = get_fec_file_path(file_name)
+		processed_rows = 0
+		with open(path, "w", encoding="utf-8", newline="") as fec_file:
+			fec_file.write(FEC_SEPARATOR.join(FEC_FIELDS) + "\r\n")
+			for rows in iter_unexported_fec_rows(
+				self.company, self.fiscal_year, getdate(self.from_date), getdate(self.to_date), now_datetime()
+			):
+				write_fec_lines(fec_file, rows)
+				processed_rows += len(rows)
+				self.publish_progress(processed_rows)
+
+		file_doc = attach_fec_file(path, file_name, "Company", self.company)
+		self.db_set({"fec_file": file_doc.file_url, "processed_rows": processed_rows})
+
+	def merge_chunks(self):
+		chunks = self.chunks
+		if frappe.get_cached_value("Company", self.company, "type_export_fec") != "Standard FEC Export":
+			chunks = list(reversed(chunks))
+
+		file_name = get_fec_file_name(self.company, self.fiscal_year)
+		path = get_fec_file_path(file_name)
+		with open(path, "w", encoding="utf-8", newline="") as fec_file:
+			fec_file.write(FEC_SEPARATOR.join(FEC_FIELDS) + "\r\n")
+			for chunk in chunks:
+				with open(self.get_chunk_path(chunk), encoding="utf-8", newline="") as chunk_file:
+					shutil.copyfileobj(chunk_file, fec_file)
+
+		file_doc = attach_fec_file(path, file_name, "Company", self.company)
+		self.db_set("fec_file", file_doc.file_url)
+		shutil.rmtree(self.get_chunks_path(), ignore_errors=True)
+
+
+def generate_fec_file(fec_export):
+	frappe.get_doc("FEC Export", fec_export).generate()
+
+
+def write_chunk_file(site, sites_path, fec_export, chunk):
+	"""Write one chunk of an FEC Export from a pool process, on its own connection"""
+	frappe.init(site=site, sites_path=sites_path)
+	frappe.connect()
+	try:
+		doc = frappe.get_doc("FEC Export", fec_export)
+		return doc.write_chunk(next(c for c in doc.chunks if c.name == chunk))
+	finally:
+		frappe.destroy()
+
+
+@frappe.whitelist()
+def create_fec_export(
+	company, fiscal_year, from_date=None, to_date=None, hide_already_exported=0, mark_as_exported=0
+):
+	fec_export = frappe.get_doc({
+		"doctype": "FEC Export",
+		"company": company,
+		"fiscal_year": fiscal_year,
+		"from_date": from_date,
+		"to_date": to_date,
+		"hide_already_exported": cint(hide_already_exported),
+		"mark_as_exported": cint(mark_as_exported),
+	}).insert()
+	fec_export.enqueue_export()
+
+	return fec_export.name
@@ -0,0 +1,337 @@
+# Copyright (c) 2024, Scopen and Contributors
+# See license.txt
+
+import os
+import re
+import shutil
+
+import frappe
+from erpnext.accounts.doctype.payment_entry.payment_entry import get_payment_entry
+from erpnext.accounts.doctype.sales_invoice.test_sales_invoice import create_sales_invoice
+from erpnext.accounts.utils import get_fiscal_year
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import add_days, add_to_date, format_datetime, getdate, now_datetime, nowdate
+
+from erpnext_france.controllers.mark_gl_entry_as_exported import (
+	get_report_read_at_key,
+	mark_gl_entries_as_exported,
+	set_report_read_at,
+)
+from erpnext_france.utils.fec import (
+	FECFormatter,
+	FECLabels,
+	LettrageResolver,
+	get_gl_entries,
+	get_month_partitions,
+)
+
+COMPANY = "_Test Company"
+ACCOUNT_NUMBERS = {
+	"Debtors - _TC": "411000",
+	"Sales - _TC": "706000",
+	"_Test Bank - _TC": "512000",
+}
+
+
+def get_export_args(posting_date=None):
+	fiscal_year, year_start_date, year_end_date = get_fiscal_year(
+		posting_date or nowdate(), company=COMPANY
+	)
+	return COMPANY, fiscal_year, year_start_date, year_end_date, False
+
+
+def get_baseline_row(d, company_currency, let_dates):
+	"""FEC line of a GL Entry as formatted by the report before the export was reworked"""
+	JournalCode = d.accounting_journal or re.split("-|/|[0-9]", d.voucher_no)[0]
+	account_number = frappe.db.get_value("Account", d.account, "account_number")
+
+	CompAuxNum = CompAuxLib = ""
+	if d.party_type == "Customer":
+		CompAuxNum, CompAuxLib = frappe.db.get_value("Customer", d.party, ["name", "customer_name"])
+
+	if d.remarks and d.remarks.lower() not in ("no remarks",):
+		EcritureLib = d.remarks
+	elif d.voucher_type == "Sales Invoice":
+		EcritureLib = frappe.db.get_value("Sales Invoice", d.voucher_no, "title")
+	else:
+		EcritureLib = d.voucher_type
+
+	def amount(value):
+		return "{:.2f}".format(value).replace(".", ",")
+
+	if d.account_currency != company_currency:
+		montant_devise = amount(d.debitCurr) if d.debitCurr != 0 else amount(d.creditCurr)
+	else:
+		montant_devise = amount(d.debit) if d.debit != 0 else amount(d.credit)
+
+	DateLet = None
+	if d.against_voucher and len(let_dates) > 1:
+		DateLet = format_datetime(max(let_dates), "yyyyMMdd")
+
+	return [
+		JournalCode,
+		frappe.db.get_value("Accounting Journal", {"journal_code": JournalCode}, "journal_name"),
+		d.accounting_entry_number,
+		format_datetime(d.GlPostDate, "yyyyMMdd"),
+		account_number,
+		d.account,
+		CompAuxNum,
+		CompAuxLib,
+		d.voucher_no or "Sans Reference",
+		" ".join(EcritureLib.splitlines()),
+		amount(d.debit),
+		amount(d.credit),
+		d.against_voucher if DateLet else "",
+		DateLet or "",
+		format_datetime(d.GlPostDate, "yyyyMMdd"),
+		montant_devise,
+		d.account_currency,
+		format_datetime(d.ExportDate, "yyyy-MM-dd HH:mm"),
+		d.GlName,
+	]
+
+
+class TestFECExport(FrappeTestCase):
+	def make_fec_export(self):
+		fec_export = frappe.get_doc(
+			{"doctype": "FEC Export", "company": COMPANY, "fiscal_year": get_export_args()[1]}
+		).insert()
+		self.addCleanup(shutil.rmtree, fec_export.get_chunks_path(), ignore_errors=True)
+		return fec_export
+
+	def test_month_partitions(self):
+		self.assertEqual(
+			get_month_partitions("2024-01-15", "2024-03-10"),
+			[
+				(getdate("2024-01-15"), getdate("2024-01-31")),
+				(getdate("2024-02-01"), getdate("2024-02-29")),
+				(getdate("2024-03-01"), getdate("2024-03-10")),
+			],
+		)
+
+	def test_month_partitions_boundaries(self):
+		self.assertEqual(
+			get_month_partitions("2024-05-31", "2024-05-31"),
+			[(getdate("2024-05-31"), getdate("2024-05-31"))],
+		)
+		self.assertEqual(
+			get_month_partitions("2023-12-31", "2024-01-01"),
+			[
+				(getdate("2023-12-31"), getdate("2023-12-31")),
+				(getdate("2024-01-01"), getdate("2024-01-01")),
+			],
+		)
+		self.assertEqual(get_month_partitions("2024-02-01", "2024-01-31"), [])
+
+		partitions = get_month_partitions("2024-01-01", "2024-12-31")
+		self.assertEqual(len(partitions), 12)
+		self.assertEqual(partitions[0], (getdate("2024-01-01"), getdate("2024-01-31")))
+		self.assertEqual(partitions[-1], (getdate("2024-12-01"), getdate("2024-12-31")))
+		for previous, partition in zip(partitions, partitions[1:]):
+			self.assertEqual(add_days(previous[1], 1), partition[0])
+
+	def test_dates_from_fiscal_year(self):
+		year_start_date, year_end_date = get_export_args()[2:4]
+		fec_export = self.make_fec_export()
+		self.assertEqual(getdate(fec_export.from_date), getdate(year_start_date))
+		self.assertEqual(getdate(fec_export.to_date), getdate(year_end_date))
+		self.assertEqual(
+			[(getdate(c.from_date), getdate(c.to_date)) for c in fec_export.chunks],
+			get_month_partitions(year_start_date, year_end_date),
+		)
+
+	def test_invalid_fiscal_year(self):
+		fec_export = frappe.get_doc(
+			{"doctype": "FEC Export", "company": COMPANY, "fiscal_year": "_Test Missing Fiscal Year"}
+		)
+		self.assertRaises(frappe.ValidationError, fec_export.set_dates)
+
+		fec_export.fiscal_year = None
+		fec_export.set_dates()
+		self.assertFalse(fec_export.from_date)
+
+	def test_resume_from_completed_chunks(self):
+		fec_export = self.make_fec_export()
+		chunks = [(c.name, c.from_date, c.to_date) for c in fec_export.chunks]
+
+		completed_chunk = fec_export.chunks[0]
+		completed_chunk.status = "Completed"
+		completed_chunk.rows = 10
+		os.makedirs(fec_export.get_chunks_path(), exist_ok=True)
+		with open(fec_export.get_chunk_path(completed_chunk), "w") as chunk_file:
+			chunk_file.write("")
+
+		# The chunks are kept once one of them is completed
+		fec_export.save()
+		self.assertEqual([(c.name, c.from_date, c.to_date) for c in fec_export.chunks], chunks)
+
+		pending_chunks = fec_export.get_pending_chunks()
+		self.assertNotIn(completed_chunk.name, [c.name for c in pending_chunks])
+		self.assertEqual(len(pending_chunks), len(chunks) - 1)
+
+		# A completed chunk whose file is lost is written again
+		os.remove(fec_export.get_chunk_path(completed_chunk))
+		self.assertIn(completed_chunk.name, [c.name for c in fec_export.get_pending_chunks()])
+
+	def test_resume_after_killed_job(self):
+		fec_export = self.make_fec_export()
+		fec_export.db_set("status", "In Progress")
+
+		# No job runs the export anymore: it is queued again
+		self.assertFalse(fec_export.is_running())
+		fec_export.enqueue_export()
+		self.assertEqual(frappe.db.get_value("FEC Export", fec_export.name, "status"), "Queued")
+
+	def test_chunks_reset_without_completed_chunks(self):
+		fec_export = self.make_fec_export()
+		fec_export.to_date = add_days(fec_export.from_date, 40)
+		fec_export.save()
+		self.assertEqual(len(fec_export.chunks), 2)
+		self.assertTrue(all(c.status == "Pending" for c in fec_export.chunks))
+
+
+class TestFECFormatter(FrappeTestCase):
+	@classmethod
+	def setUpClass(cls):
+		super().setUpClass()
+		for account, account_number in ACCOUNT_NUMBERS.items():
+			frappe.db.set_value("Account", account, "account_number", account_number)
+
+	def get_voucher_entries(self, voucher_no, export_args):
+		return [d for d in get_gl_entries(*export_args) if d.voucher_no == voucher_no]
+
+	def test_format_row_matches_baseline(self):
+		si = create_sales_invoice(company=COMPANY, rate=120)
+		frappe.db.set_value("GL Entry", {"voucher_no": si.name}, "remarks", "Line 1\nLine 2")
+		export_args = get_export_args(si.posting_date)
+
+		formatter = FECFormatter(COMPANY, LettrageResolver(*export_args), FECLabels(*export_args))
+		company_currency = frappe.get_cached_value("Company", COMPANY, "default_currency")
+
+		entries = self.get_voucher_entries(si.name, export_args)
+		self.assertEqual(len(entries), 2)
+		for d in entries:
+			let_dates = frappe.get_all(
+				"GL Entry",
+				filters={"against_voucher": d.against_voucher, "party": d.party},
+				pluck="posting_date",
+			) if d.against_voucher else []
+			self.assertEqual(formatter.format_row(d), get_baseline_row(d, company_currency, let_dates))
+
+		debtors_row = formatter.format_row(next(d for d in entries if d.account == "Debtors - _TC"))
+		self.assertEqual(debtors_row[4], "411000")
+		self.assertEqual(debtors_row[6:8], ["_Test Customer", "_Test Customer"])
+		self.assertEqual(debtors_row[10:12], ["120,00", "0,00"])
+
+	def test_format_row_uses_title_without_remarks(self):
+		si = create_sales_invoice(company=COMPANY, rate=80)
+		frappe.db.set_value("GL Entry", {"voucher_no": si.name}, "remarks", "No Remarks")
+		export_args = get_export_args(si.posting_date)
+
+		formatter = FECFormatter(COMPANY, LettrageResolver(*export_args), FECLabels(*export_args))
+		for d in self.get_voucher_entries(si.name, export_args):
+			self.assertEqual(formatter.format_row(d)[9], si.title)
+
+	def test_format_row_skips_zero_entries(self):
+		si = create_sales_invoice(company=COMPANY, rate=50)
+		export_args = get_export_args(si.posting_date)
+
+		formatter = FECFormatter(COMPANY, LettrageResolver(*export_args), FECLabels(*export_args))
+		d = self.get_voucher_entries(si.name, export_args)[0]
+		d.debit = d.credit = 0
+		self.assertIsNone(formatter.format_row(d))
+
+
+class TestLettrageResolver(FrappeTestCase):
+	def setUp(self):
+		self.export_args = get_export_args()
+		self.invoice_date = getdate(add_days(self.export_args[2], 5))
+		self.invoice = create_sales_invoice(
+			company=COMPANY, posting_date=self.invoice_date, rate=100, do_not_submit=True
+		)
+		self.invoice.set_posting_time = 1
+		self.invoice.submit()
+
+	def make_payment(self, amount, days):
+		pe = get_payment_entry(
+			"Sales Invoice", self.invoice.name, party_amount=amount, bank_account="_Test Bank - _TC"
+		)
+		pe.posting_date = add_days(self.invoice_date, days)
+		pe.reference_no = pe.posting_date
+		pe.reference_date = pe.posting_date
+		pe.insert()
+		pe.submit()
+		return pe
+
+	def get_invoice_entry(self):
+		return frappe.db.get_value(
+			"GL Entry",
+			{"voucher_no": self.invoice.name, "account": "Debtors - _TC", "is_cancelled": 0},
+			["against_voucher_type", "against_voucher", "party"],
+			as_dict=True,
+		)
+
+	def get_date_let(self, export_args=None, partition=None):
+		resolver = LettrageResolver(*(export_args or self.export_args), partition=partition)
+		return resolver.get_date_let(self.get_invoice_entry())
+
+	def test_unreconciled_invoice(self):
+		self.assertIsNone(self.get_date_let())
+
+	def test_partly_reconciled_invoice(self):
+		pe = self.make_payment(40, 10)
+		self.assertEqual(self.get_date_let(), format_datetime(pe.posting_date, "yyyyMMdd"))
+
+	def test_fully_reconciled_invoice(self):
+		self.make_payment(40, 10)
+		pe = self.make_payment(60, 20)
+		self.assertEqual(
+			frappe.db.get_value("Sales Invoice", self.invoice.name, "outstanding_amount"), 0
+		)
+		self.assertEqual(self.get_date_let(), format_datetime(pe.posting_date, "yyyyMMdd"))
+
+	def test_payment_outside_of_the_export(self):
+		pe = self.make_payment(100, 10)
+		company, fiscal_year, from_date, to_date, hide_already_exported = self.export_args
+
+		# Only the invoice is exported: the date comes from the whole ledger
+		export_args = (company, fiscal_year, from_date, self.invoice_date, hide_already_exported)
+		self.assertEqual(self.get_date_let(export_args), format_datetime(pe.posting_date, "yyyyMMdd"))
+
+		# The invoice partition is resolved against the whole export
+		self.assertEqual(
+			self.get_date_let(partition=(self.invoice_date, self.invoice_date)),
+			format_datetime(pe.posting_date, "yyyyMMdd"),
+		)
+
+
+class TestMarkAsExported(FrappeTestCase):
+	def get_export_dates(self, si):
+		return set(frappe.get_all("GL Entry", filters={"voucher_no": si.name}, pluck="export_date"))
+
+	def test_mark_entries_read_by_the_report(self):
+		company, fiscal_year, from_date, to_date = get_export_args()[:4]
+		exported = create_sales_invoice(company=COMPANY)
+		self.assertRaises(
+			frappe.ValidationError, mark_gl_entries_as_exported, company, fiscal_year, from_date, to_date
+		)
+
+		set_report_read_at(company, fiscal_year, from_date, to_date, now_datetime())
+		self.addCleanup(
+			frappe.cache().delete_value,
+			get_report_read_at_key(company, fiscal_year, from_date, to_date),
+			user=frappe.session.user,
+		)
+
+		# Posted after the report read the entries, so not in the downloaded file
+		posted_later = create_sales_invoice(company=COMPANY)
+		gle = frappe.qb.DocType("GL Entry")
+		(
+			frappe.qb.update(gle)
+			.set(gle.creation, add_to_date(now_datetime(), minutes=1))
+			.where(gle.voucher_no == posted_later.name)
+		).run()
+
+		mark_gl_entries_as_exported(company, fiscal_year, from_date, to_date)
+		self.assertNotIn(None, self.get_export_dates(exported))
+		self.assertEqual(self.get_export_dates(posted_later), {None})
@@ -64,6 +64,10 @@ frappe.query_reports["Fichier des Ecritures Comptables [FEC]"] = {
 			}
 		});
 
+		query_report.page.add_inner_button(__("Export File"), function () {
+			fec_export_file(query_report);
+		});
+
 		query_report.add_make_chart_button = function () {
 			//
 		};
@@ -85,22 +89,40 @@ let fec_export = function (query_report, mark_exported) {
 				const column_row = query_report.columns.filter(col => !['ExportDate', 'GlName'].includes(col.fieldname)).map(col => col.label);
 				const column_data = query_report.get_data_for_csv(false);
 
-				let gl_entries = [];
 				column_data.forEach(data => {
-					gl_entries.push([data.pop(), data.pop()])
+					data.splice(-2, 2);
 				});
 
 				const result = [column_row].concat(column_data);
 				downloadify(result, null, title);
 
 				if (mark_exported) {
-					mark_as_exported(gl_entries);
+					mark_as_exported(query_report.get_values());
 				}
 			});
 		}
 	});
 };
 
+let fec_export_file = function (query_report) {
+	const filters = query_report.get_values();
+	frappe.call({
+		method: "erpnext_france.erpnext_france.doctype.fec_export.fec_export.create_fec_export",
+		args: {
+			company: filters.company,
+			fiscal_year: filters.fiscal_year,
+			from_date: filters.from_date,
+			to_date: filters.to_date,
+			hide_already_exported: filters.hide_already_exported ? 1 : 0
+		},
+		callback: function (r) {
+			if (r.message) {
+				frappe.set_route("Form", "FEC Export", r.message);
+			}
+		}
+	});
+};
+
 let downloadify = function (data, roles, title) {
 	if (roles && roles.length && !has_common(roles, roles)) {
 		frappe.msgprint(__("Export not allowed. You need {0} role to export.", [frappe.utils.comma_or(roles)]));
@@ -141,19 +163,25 @@ let to_tab_csv = function (data) {
 };
 
 
-function mark_as_exported(gl_entries) {
+function mark_as_exported(filters) {
 	frappe.call({
-		method: "erpnext_france.controllers.mark_gl_entry_as_exported.mark_gl_entry_as_exported",
-		args: {gl_entries},
+		method: "erpnext_france.controllers.mark_gl_entry_as_exported.mark_gl_entries_as_exported",
+		args: {
+			company: filters.company,
+			fiscal_year: filters.fiscal_year,
+			from_date: filters.from_date,
+			to_date: filters.to_date
+		},
 		callback: function (response) {
 			if (!response || !response.message) {
 				frappe.throw(__('No Response From Server'));
 				return
 			}
 
-			if (response.message.error) {
-				return
-			}
+			frappe.show_alert({
+				message: __("{0} GL Entries marked as exported", [response.message.count]),
+				indicator: "green"
+			});
 		}
 	});
-}
\ No newline at end of file
+}
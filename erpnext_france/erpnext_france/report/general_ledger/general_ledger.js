@@ -2,4 +2,56 @@
 // License: GNU General Public License v3. See license.txt
 {% include 'erpnext/accounts/report/general_ledger/general_ledger.js' %};
 
+frappe.query_reports["General Ledger"].filters.push({
+	"fieldname": "paginate",
+	"label": __("Load Page by Page"),
+	"fieldtype": "Check",
+	"default": 0,
+	on_change: function (query_report) {
+		// The pages are not grouped
+		if (query_report.get_filter_value("paginate") && query_report.get_filter_value("group_by")) {
+			query_report.set_filter_value("group_by", "");
+		} else {
+			query_report.refresh();
+		}
+	}
+});
 
+let general_ledger_onload = frappe.query_reports["General Ledger"].onload;
+frappe.query_reports["General Ledger"].onload = function (query_report) {
+	general_ledger_onload && general_ledger_onload(query_report);
+
+	query_report.page.add_inner_button(__("Load More"), function () {
+		load_next_ledger_page(query_report);
+	});
+};
+
+function load_next_ledger_page(query_report) {
+	const filters = query_report.get_filter_values();
+	if (!filters.paginate) {
+		frappe.msgprint(__("Check {0} to load the General Ledger page by page", [__("Load Page by Page")]));
+		return;
+	}
+
+	// The server returns the cursor of the next page with the opening row, and it is moved forward
+	// with each page, whatever the order of the rows in the datatable
+	const opening_row = (query_report.data || []).find((row) => "next_cursor" in row);
+	if (!opening_row || !opening_row.next_cursor) {
+		frappe.show_alert({message: __("All the GL Entries are loaded"), indicator: "green"});
+		return;
+	}
+
+	frappe.xcall("erpnext_france.erpnext_france.report.general_ledger.general_ledger.get_ledger_page", {
+		filters: filters,
+		cursor: opening_row.next_cursor
+	}).then((page) => {
+		opening_row.next_cursor = page.next_cursor;
+		if (!page.rows.length) {
+			frappe.show_alert({message: __("All the GL Entries are loaded"), indicator: "green"});
+			return;
+		}
+
+		query_report.data.push(...page.rows);
+		query_report.datatable.appendRows(page.rows);
+	});
+}
@@ -1,25 +1,42 @@
 # Copyright (c) 2023, Scopen and Contributors
 # License: GNU General Public License v3. See license.txt
 
+import time
+from contextlib import contextmanager
+
 import frappe
 from frappe import _
+from frappe.desk.reportview import build_match_conditions
+from frappe.query_builder.functions import Sum
+from frappe.utils import cint, cstr, flt, get_first_day
+from pypika.terms import Criterion, LiteralValue
 import erpnext.accounts.report.general_ledger.general_ledger as gl
 from erpnext.accounts.report.general_ledger.general_ledger import (
-	get_accounts_with_children, get_cost_centers_with_children, get_dimension_with_children
+	get_accounts_with_children, get_cost_centers_with_children
+)
+
+from erpnext_france.utils.balance_snapshot import (
+	get_snapshot_balance,
+	get_snapshots_horizon,
+	snapshots_ready,
 )
 
+ACCOUNT_DETAILS_CACHE_KEY = "erpnext_france_general_ledger_accounts"
+LEDGER_PAGE_LENGTH = 500
+MAX_LEDGER_PAGE_LENGTH = 5000
+
 
 def execute(filters=None):
 	if not filters:
 		return [], []
 
-	account_details = {}
+	timings = {}
 
 	if filters and filters.get("print_in_account_currency") and not filters.get("account"):
 		frappe.throw(_("Select an account to print in account currency"))
 
-	for acc in frappe.db.sql("""select name, is_group from tabAccount""", as_dict=1):
-		account_details.setdefault(acc.name, acc)
+	with stage_timer(timings, "account_details"):
+		account_details = get_account_details(filters.get("company"))
 
 	if filters.get("party"):
 		filters.party = frappe.parse_json(filters.get("party"))
@@ -28,17 +45,59 @@ def execute(filters=None):
 
 	gl.validate_party(filters)
 
+	if filters.get("paginate"):
+		# The next pages are loaded by the report with get_ledger_page, from the cursor kept on the
+		# opening row
+		page = get_ledger_page(filters)
+		opening = {
+			"account": "'{0}'".format(_("Opening")),
+			"balance": page["opening_balance"],
+			"next_cursor": page["next_cursor"],
+		}
+		return get_columns(filters), [opening, *page["rows"]]
+
 	filters = gl.set_account_currency(filters)
 
 	columns = get_columns(filters)
 
 	gl.update_translations()
 
-	res = get_result(filters, account_details)
+	res = get_result(filters, account_details, timings)
+
+	frappe.logger("erpnext_france").info({"report": "General Ledger", "timings": timings})
 
 	return columns, res
 
 
+@contextmanager
+def stage_timer(timings, stage):
+	"""Record the duration of a stage of the report generation in `timings`"""
+	start = time.monotonic()
+	try:
+		yield
+	finally:
+		timings[stage] = round(time.monotonic() - start, 3)
+
+
+def get_account_details(company):
+	"""Return the accounts of the company, cached until an Account changes"""
+	if not company:
+		return {}
+
+	return frappe.cache().hget(
+		ACCOUNT_DETAILS_CACHE_KEY,
+		company,
+		lambda: {
+			acc.name: acc
+			for acc in frappe.get_all("Account", filters={"company": company}, fields=["name", "is_group"])
+		},
+	)
+
+
+def clear_account_details_cache(*args, **kwargs):
+	frappe.cache().delete_key(ACCOUNT_DETAILS_CACHE_KEY)
+
+
 def get_columns(filters):
 	columns = gl.get_columns(filters)
 	acc_journal_columns = {
@@ -53,16 +112,21 @@ def get_columns(filters):
 	return columns
 
 
-def get_result(filters, account_details):
+def get_result(filters, account_details, timings=None):
+	timings = timings if timings is not None else {}
 	accounting_dimensions = []
 	if filters.get("include_dimensions"):
 		accounting_dimensions = gl.get_accounting_dimensions()
 
-	gl_entries = get_gl_entries(filters, accounting_dimensions)
+	with stage_timer(timings, "gl_entries"):
+		gl_entries = get_gl_entries(filters, accounting_dimensions)
 
-	data = gl.get_data_with_opening_closing(filters, account_details, accounting_dimensions, gl_entries)
+	with stage_timer(timings, "opening_closing"):
+		data = gl.get_data_with_opening_closing(filters, account_details, accounting_dimensions, gl_entries)
+
+	with stage_timer(timings, "result"):
+		result = gl.get_result_as_list(data, filters)
 
-	result = gl.get_result_as_list(data, filters)
 	return result
 
 
@@ -70,6 +134,49 @@ def get_gl_entries(filters, accounting_dimensions):
 	currency_map = gl.get_currency(filters)
 
 	gle = frappe.qb.DocType("GL Entry")
+	gl_entries = get_gl_entries_query(filters, gle, accounting_dimensions)
+
+	order_by_statement = gl_entries.orderby(
+		gle.posting_date,
+		gle.account,
+		gle.creation
+	)
+
+	if filters.get("include_dimensions"):
+		order_by_statement = gl_entries.orderby(
+			gle.posting_date,
+			gle.creation
+		)
+
+	if filters.get("group_by") == "Group by Voucher":
+		order_by_statement = gl_entries.orderby(
+			gle.posting_date,
+			gle.voucher_type,
+			gle.voucher_no
+		)
+	if filters.get("group_by") == "Group by Account":
+		order_by_statement = gl_entries.orderby(
+			gle.account,
+			gle.posting_date,
+			gle.creation
+		)
+
+	gl_entries = order_by_statement
+
+	if filters.get("include_default_book_entries"):
+		filters["company_fb"] = frappe.get_cached_value(
+			"Company", filters.get("company"), "default_finance_book"
+		)
+
+	gl_entries = get_conditions(filters, gle, gl_entries)
+
+	if filters.get("presentation_currency"):
+		return gl.convert_to_presentation_currency(gl_entries.run(as_dict=1), currency_map)
+	else:
+		return gl_entries.run(as_dict=1)
+
+
+def get_gl_entries_query(filters, gle, accounting_dimensions):
 	gl_entries = (
 		frappe.qb.from_(gle)
 		.select(
@@ -118,48 +225,170 @@ def get_gl_entries(filters, accounting_dimensions):
 	if filters.get("show_remarks"):
 		gl_entries = (gl_entries.select(gle.remarks))
 
-	order_by_statement = gl_entries.orderby(
-		gle.posting_date,
-		gle.account,
-		gle.creation
-	)
+	return gl_entries
 
-	if filters.get("include_dimensions"):
-		order_by_statement = gl_entries.orderby(
-			gle.posting_date,
-			gle.creation
-		)
 
-	if filters.get("group_by") == "Group by Voucher":
-		order_by_statement = gl_entries.orderby(
-			gle.posting_date,
-			gle.voucher_type,
-			gle.voucher_no
-		)
-	if filters.get("group_by") == "Group by Account":
-		order_by_statement = gl_entries.orderby(
-			gle.account,
-			gle.posting_date,
-			gle.creation
-		)
+@frappe.whitelist()
+def get_ledger_page(filters, cursor=None, page_length=LEDGER_PAGE_LENGTH):
+	"""
+	Return one page of the General Ledger with running balances, read after the
+	(posting_date, account, creation, name) `cursor` returned with the previous page
 
-	gl_entries = order_by_statement
+	The first page computes the opening balance with one aggregate query, the next ones carry
+	the balance over in the cursor, so that no page reads more than `page_length` GL Entries.
+	"""
+	frappe.has_permission("GL Entry", "read", throw=True)
+
+	filters = frappe._dict(frappe.parse_json(filters))
+	cursor = frappe._dict(frappe.parse_json(cursor)) if cursor else None
+	page_length = min(cint(page_length) or LEDGER_PAGE_LENGTH, MAX_LEDGER_PAGE_LENGTH)
+
+	if filters.get("presentation_currency"):
+		frappe.throw(_("The presentation currency is not available in the paginated General Ledger"))
+
+	if filters.get("group_by"):
+		frappe.throw(_("The paginated General Ledger cannot be grouped, clear the Group By filter"))
+
+	if filters.get("party"):
+		filters.party = frappe.parse_json(filters.get("party"))
+
+	gl.validate_filters(filters, get_account_details(filters.get("company")))
+	gl.validate_party(filters)
 
 	if filters.get("include_default_book_entries"):
 		filters["company_fb"] = frappe.get_cached_value(
 			"Company", filters.get("company"), "default_finance_book"
 		)
 
-	gl_entries = get_conditions(filters, gle, gl_entries)
+	accounting_dimensions = []
+	if filters.get("include_dimensions"):
+		accounting_dimensions = gl.get_accounting_dimensions()
 
-	if filters.get("presentation_currency"):
-		return gl.convert_to_presentation_currency(gl_entries.run(as_dict=1), currency_map)
+	gle = frappe.qb.DocType("GL Entry")
+	opening_balance = None
+	if cursor:
+		balance = flt(cursor.balance)
 	else:
-		return gl_entries.run(as_dict=1)
+		balance = opening_balance = get_opening_balance(filters, gle)
+
+	gl_entries = (
+		get_gl_entries_query(filters, gle, accounting_dimensions)
+		.where(gle.is_opening == "No")
+		.where(gle.posting_date >= filters.from_date)
+		.orderby(gle.posting_date)
+		.orderby(gle.account)
+		.orderby(gle.creation)
+		.orderby(gle.name)
+		.limit(page_length)
+	)
+	gl_entries = get_conditions(filters, gle, gl_entries, from_date_condition=False)
 
+	if cursor:
+		gl_entries = gl_entries.where(
+			get_after_cursor_condition(
+				(gle.posting_date, gle.account, gle.creation, gle.name),
+				(cursor.posting_date, cursor.account, cursor.creation, cursor.name),
+			)
+		)
 
-def get_conditions(filters, gle, gl_entries):
-	filters_query = gl_entries
+	rows = gl_entries.run(as_dict=1)
+	for row in rows:
+		balance += flt(row.debit) - flt(row.credit)
+		row.balance = balance
+
+	next_cursor = None
+	if len(rows) == page_length:
+		next_cursor = {
+			"posting_date": str(rows[-1].posting_date),
+			"account": rows[-1].account,
+			"creation": str(rows[-1].creation),
+			"name": rows[-1].gl_entry,
+			"balance": balance,
+		}
+
+	return {"opening_balance": opening_balance, "rows": rows, "next_cursor": next_cursor}
+
+
+def get_opening_balance(filters, gle):
+	if not can_use_balance_snapshots(filters):
+		query = (
+			frappe.qb.from_(gle)
+			.select(Sum(gle.debit) - Sum(gle.credit))
+			.where((gle.posting_date < filters.from_date) | (gle.is_opening == "Yes"))
+		)
+		query = get_conditions(filters, gle, query, from_date_condition=False)
+
+		return flt(query.run()[0][0])
+
+	# The months before the one of from_date and before the horizon come from the snapshots,
+	# the rest from the ledger
+	month_start = min(get_first_day(filters.from_date), get_snapshots_horizon(filters.company))
+	query = (
+		frappe.qb.from_(gle)
+		.select(Sum(gle.debit) - Sum(gle.credit))
+		.where(gle.posting_date >= month_start)
+		.where((gle.posting_date < filters.from_date) | (gle.is_opening == "Yes"))
+	)
+	query = get_conditions(filters, gle, query, from_date_condition=False)
+	month_balance = flt(query.run()[0][0])
+
+	party_types = [filters.party_type] if filters.get("party_type") else None
+	if not party_types and filters.get("group_by") == "Group by Party":
+		party_types = ["Customer", "Supplier"]
+
+	return month_balance + get_snapshot_balance(
+		filters.company,
+		month_start,
+		accounts=filters.get("account"),
+		party_types=party_types,
+		parties=filters.get("party"),
+		finance_books=get_snapshot_finance_books(filters),
+	)
+
+
+def can_use_balance_snapshots(filters):
+	"""The snapshots hold the balances by company, account, party and finance book only"""
+	if not snapshots_ready(filters.company) or build_match_conditions("GL Entry"):
+		return False
+
+	unsupported_filters = (
+		"cost_center",
+		"project",
+		"voucher_no",
+		"against_voucher_no",
+		"ignore_err",
+		"voucher_no_not_in",
+		"show_cancelled_entries",
+	)
+	dimension_filters = [
+		dimension.fieldname for dimension in gl.get_accounting_dimensions(as_list=False)
+	]
+
+	return not any(filters.get(fieldname) for fieldname in (*unsupported_filters, *dimension_filters))
+
+
+def get_snapshot_finance_books(filters):
+	"""Return the finance books selected by get_conditions, entries without finance book being snapshotted with ''"""
+	if filters.get("finance_book"):
+		return ["", filters.finance_book]
+
+	if filters.get("include_default_book_entries"):
+		return ["", filters.company_fb or ""]
+
+	return [""]
+
+
+def get_after_cursor_condition(columns, values):
+	"""Return the condition on the rows after `values` in the order of `columns`, in a form the indexes can use"""
+	condition = columns[-1] > values[-1]
+	for column, value in reversed(list(zip(columns[:-1], values[:-1]))):
+		condition = (column > value) | ((column == value) & condition)
+
+	return condition
+
+
+def get_conditions(filters, gle, gl_entries, from_date_condition=True):
+	filters_query = gl_entries.where(gle.company == filters.company)
 	if filters.get("account"):
 		filters.account = get_accounts_with_children(filters.account)
 		filters_query = (filters_query.where(gle.account.isin(filters.account)))
@@ -199,7 +428,7 @@ def get_conditions(filters, gle, gl_entries):
 	if filters.get("party"):
 		filters_query = (filters_query.where(gle.party.isin(filters.party)))
 
-	if not (
+	if from_date_condition and not (
 			filters.get("account")
 			or filters.get("party")
 			or filters.get("group_by") in ["Group by Account", "Group by Party"]
@@ -233,26 +462,43 @@ def get_conditions(filters, gle, gl_entries):
 	if not filters.get("show_cancelled_entries"):
 		filters_query = (filters_query.where(gle.is_cancelled == 0))
 
-	# from frappe.desk.reportview import build_match_conditions
-	#
-	# match_conditions = build_match_conditions("GL Entry")
-	#
-	# if match_conditions:
-	# 	conditions.append(match_conditions)
-
-	# accounting_dimensions = gl.get_accounting_dimensions(as_list=False)
-	#
-	# if accounting_dimensions:
-	# 	for dimension in accounting_dimensions:
-	# 		# Ignore 'Finance Book' set up as dimension in below logic, as it is already handled in above section
-	# 		if not dimension.disabled and dimension.document_type != "Finance Book":
-	# 			if filters.get(dimension.fieldname):
-	# 				if frappe.get_cached_value("DocType", dimension.document_type, "is_tree"):
-	# 					filters[dimension.fieldname] = get_dimension_with_children(
-	# 						dimension.document_type, filters.get(dimension.fieldname)
-	# 					)
-	# 					conditions.append("{0} in %({0})s".format(dimension.fieldname))
-	# 				else:
-	# 					conditions.append("{0} in %({0})s".format(dimension.fieldname))
+	filters_query = get_dimension_conditions(filters, filters_query, gle)
+
+	match_conditions = build_match_conditions("GL Entry")
+	if match_conditions:
+		filters_query = filters_query.where(LiteralValue("({0})".format(match_conditions)))
+
+	return filters_query
+
+
+def get_dimension_conditions(filters, filters_query, gle):
+	"""Filter on the accounting dimensions, the children of tree dimensions being selected by their nested set"""
+	for dimension in gl.get_accounting_dimensions(as_list=False):
+		# Ignore 'Finance Book' set up as dimension, as it is already handled by the finance book filters
+		if dimension.disabled or dimension.document_type == "Finance Book":
+			continue
+
+		values = filters.get(dimension.fieldname)
+		if not values:
+			continue
+
+		values = frappe.parse_json(values) if isinstance(values, str) and values.startswith("[") else values
+		values = values if isinstance(values, (list, tuple)) else [values]
+
+		ranges = []
+		if frappe.get_cached_value("DocType", dimension.document_type, "is_tree"):
+			ranges = frappe.get_all(dimension.document_type, filters={"name": ("in", values)}, fields=["lft", "rgt"])
+
+		if ranges:
+			tree = frappe.qb.DocType(dimension.document_type)
+			filters_query = filters_query.where(
+				gle[dimension.fieldname].isin(
+					frappe.qb.from_(tree)
+					.select(tree.name)
+					.where(Criterion.any((tree.lft >= r.lft) & (tree.rgt <= r.rgt) for r in ranges))
+				)
+			)
+		else:
+			filters_query = filters_query.where(gle[dimension.fieldname].isin(values))
 
 	return filters_query
@@ -0,0 +1,82 @@
+# Copyright (c) 2024, Scopen and Contributors
+# See license.txt
+
+import frappe
+from erpnext.accounts.doctype.sales_invoice.test_sales_invoice import create_sales_invoice
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import add_days, flt, now, nowdate
+
+from erpnext_france.erpnext_france.report.general_ledger.general_ledger import (
+	get_after_cursor_condition,
+	get_ledger_page,
+)
+
+
+class TestGeneralLedger(FrappeTestCase):
+	def setUp(self):
+		self.posting_date = add_days(nowdate(), -1)
+		self.invoices = [
+			create_sales_invoice(posting_date=self.posting_date, rate=rate).name for rate in (100, 200, 300)
+		]
+
+		# Entries posted together by a bulk insert share their posting date and creation
+		gle = frappe.qb.DocType("GL Entry")
+		(
+			frappe.qb.update(gle).set(gle.creation, now()).where(gle.voucher_no.isin(self.invoices))
+		).run()
+
+	def get_filters(self):
+		return frappe._dict(
+			company="_Test Company",
+			from_date=self.posting_date,
+			to_date=self.posting_date,
+			account=["Debtors - _TC"],
+			party_type="Customer",
+			party=["_Test Customer"],
+		)
+
+	def test_after_cursor_condition_on_tied_values(self):
+		gle = frappe.qb.DocType("GL Entry")
+		columns = (gle.posting_date, gle.account, gle.creation, gle.name)
+		query = (
+			frappe.qb.from_(gle)
+			.select(*columns)
+			.where(gle.voucher_no.isin(self.invoices))
+			.orderby(gle.posting_date)
+			.orderby(gle.account)
+			.orderby(gle.creation)
+			.orderby(gle.name)
+		)
+		rows = query.run()
+		self.assertEqual(len({row[:3] for row in rows if row[1] == "Debtors - _TC"}), 1)
+
+		for i, row in enumerate(rows):
+			after = query.where(get_after_cursor_condition(columns, row)).run()
+			self.assertEqual(after, rows[i + 1 :])
+
+	def test_ledger_pages(self):
+		ledger = get_ledger_page(self.get_filters(), page_length=1000)
+		self.assertIsNone(ledger["next_cursor"])
+		self.assertGreaterEqual(len(ledger["rows"]), len(self.invoices))
+
+		rows, cursor = [], None
+		while True:
+			page = get_ledger_page(self.get_filters(), cursor=cursor, page_length=2)
+			rows.extend(page["rows"])
+			if not page["next_cursor"]:
+				break
+			cursor = page["next_cursor"]
+
+		self.assertEqual([row.gl_entry for row in rows], [row.gl_entry for row in ledger["rows"]])
+		self.assertEqual(
+			[flt(row.balance) for row in rows], [flt(row.balance) for row in ledger["rows"]]
+		)
+		self.assertEqual(
+			flt(rows[-1].balance),
+			flt(ledger["opening_balance"]) + sum(flt(row.debit) - flt(row.credit) for row in rows),
+		)
+
+	def test_ledger_pages_are_not_grouped(self):
+		filters = self.get_filters()
+		filters.group_by = "Group by Voucher (Consolidated)"
+		self.assertRaises(frappe.ValidationError, get_ledger_page, filters)
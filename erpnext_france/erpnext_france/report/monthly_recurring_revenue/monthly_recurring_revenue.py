@@ -1,6 +1,8 @@
 # Copyright (c) 2020, Dokos SAS and contributors
 # For license information, please see license.txt
 
+from bisect import bisect_left, bisect_right
+
 import frappe
 from frappe import _
 from frappe.utils import date_diff, flt, getdate, month_diff, nowdate
@@ -68,42 +70,35 @@ def get_data(filters, period_list):
 		],
 	)
 
-	filtered_invoices = []
+	invoices_by_subscription = {}
+	for invoice in invoices:
+		invoices_by_subscription.setdefault(invoice.subscription, []).append(invoice)
+
+	invoices_by_customer = {}
+	subscriptions_by_customer = {}
 	for subscription in subscriptions:
-		filtered_invoices.extend([x for x in invoices if x.subscription == subscription.name])
+		subscriptions_by_customer.setdefault(subscription.customer, []).append(subscription)
+		for invoice in invoices_by_subscription.get(subscription.name, []):
+			invoices_by_customer.setdefault(invoice.customer, []).append(invoice)
 
-	customers = list(
-		set([x.customer for x in filtered_invoices] + [x.customer for x in subscriptions])
-	)
+	customers = list(dict.fromkeys([*invoices_by_customer, *subscriptions_by_customer]))
+	matrix = get_mrr_matrix(customers, invoices_by_customer, subscriptions_by_customer, period_list)
 
 	result = []
 	precision = get_currency_precision() or 2
+	currency = frappe.get_cached_value("Company", filters.company, "default_currency")
 	total_row = {x.key: 0 for x in period_list if x.key != "total"}
 	total_row.update({"customer": _("Total"), "total": 0})
-	for customer in customers:
-		customer_total = 0
-		average_count = 0
-		row = {
-			"customer": customer,
-			"currency": frappe.get_cached_value("Company", filters.company, "default_currency"),
-		}
-		for index, period in enumerate(period_list):
-			total = get_invoices_mrr([x for x in filtered_invoices if x.customer == customer], period)
-			customer_subscriptions = [x for x in subscriptions if x.customer == customer]
-			if not total and period.to_date >= getdate(nowdate()):
-				total = get_subscription_mrr(customer_subscriptions, period)
-
-			customer_total += total
+	for customer, totals in zip(customers, matrix):
+		row = {"customer": customer, "currency": currency}
+		for period, total in zip(period_list, totals):
 			total_row[period.key] += total
+			row[period.key] = flt(total, precision)
 
-			if total:
-				average_count += 1
-
-			row.update({period.key: flt(total, precision)})
-
-		average_total = flt(customer_total, precision) / flt(average_count or 1)
+		average_count = len([total for total in totals if total])
+		average_total = flt(sum(totals), precision) / flt(average_count or 1)
 		total_row["total"] += average_total
-		row.update({"total": average_total})
+		row["total"] = average_total
 		result.append(row)
 
 	result.sort(key=lambda x: x["total"], reverse=True)
@@ -112,23 +107,104 @@ def get_data(filters, period_list):
 	return result
 
 
-def get_invoices_mrr(invoices, period):
-	total = 0.0
-	for invoice in invoices:
-		if invoice.from_date and invoice.to_date:
+def get_mrr_matrix(customers, invoices_by_customer, subscriptions_by_customer, period_list):
+	"""
+	Return the customers x periods matrix of the recurring revenue
+
+	Invoices without service dates are ignored. A period covered by an invoice spread over
+	several months gets the monthly amount of the first of these invoices, otherwise the total
+	of the invoices posted in the period. Current and future periods without invoices get the
+	recurring amount of the subscriptions.
+	"""
+	period_from_months = [getdate(period.from_date).replace(day=1) for period in period_list]
+	period_to_months = [getdate(period.to_date).replace(day=1) for period in period_list]
+	period_from_dates = [getdate(period.from_date) for period in period_list]
+	period_days = [date_diff(period.to_date, period.from_date) for period in period_list]
+	period_months = [month_diff(period.to_date, period.from_date) for period in period_list]
+	subscription_rates = get_subscription_rates(subscriptions_by_customer)
+	today = getdate(nowdate())
+
+	matrix = []
+	for customer in customers:
+		spread_totals = [None] * len(period_list)
+		posted_totals = [0.0] * len(period_list)
+
+		for invoice in invoices_by_customer.get(customer, []):
+			if not (invoice.from_date and invoice.to_date):
+				continue
+
+			spread_periods = range(0)
+			months = monthdelta(invoice.from_date, invoice.to_date) + 1
+			if months > 1:
+				spread_periods = range(
+					bisect_left(period_from_months, getdate(invoice.from_date).replace(day=1)),
+					bisect_right(period_to_months, getdate(invoice.to_date).replace(day=1)),
+				)
+				for index in spread_periods:
+					if spread_totals[index] is None:
+						spread_totals[index] = flt(invoice.total) / months
+
+			index = bisect_right(period_from_dates, getdate(invoice.posting_date)) - 1
 			if (
-				getdate(period.from_date).replace(day=1) >= getdate(invoice.from_date).replace(day=1)
-				and getdate(period.to_date).replace(day=1) <= getdate(invoice.to_date).replace(day=1)
-				and monthdelta(invoice.from_date, invoice.to_date) + 1 > 1
+				index >= 0
+				and index not in spread_periods
+				and period_list[index].to_date >= getdate(invoice.posting_date)
+				and getdate(period_list[index].to_date) >= getdate(invoice.from_date)
 			):
-				return flt(invoice.total) / (monthdelta(invoice.from_date, invoice.to_date) + 1)
+				posted_totals[index] += flt(invoice.total)
+
+		totals = [
+			posted if spread is None else spread for spread, posted in zip(spread_totals, posted_totals)
+		]
+
+		fixed_rate, daily_rate = subscription_rates.get(customer, (0.0, 0.0))
+		if fixed_rate or daily_rate:
+			for index, period in enumerate(period_list):
+				if not totals[index] and period.to_date >= today:
+					totals[index] = (fixed_rate + daily_rate * period_days[index]) * period_months[index]
+
+		matrix.append(totals)
+
+	return matrix
+
+
+def get_subscription_rates(subscriptions_by_customer):
+	"""
+	Return the monthly amount and the daily amount of the subscriptions of each customer,
+	the recurring amount of a period being (monthly + daily x days) x months
+	"""
+	recurrence_periods = {
+		recurrence_period.name: recurrence_period
+		for recurrence_period in frappe.get_all(
+			"Recurrence Period", fields=["name", "billing_interval", "billing_interval_count"]
+		)
+	}
 
-			elif period.to_date >= getdate(invoice.posting_date) >= period.from_date and getdate(
-				period.to_date
-			) >= getdate(invoice.from_date):
-				total += flt(invoice.total)
+	rates = {}
+	for customer, subscriptions in subscriptions_by_customer.items():
+		fixed_rate = daily_rate = 0.0
+		for subscription in subscriptions:
+			recurrence_period = recurrence_periods.get(subscription.recurrence_period)
+			if not recurrence_period:
+				continue
 
-	return total
+			subscription_total = flt(subscription.total) / flt(recurrence_period.billing_interval_count)
+
+			if recurrence_period.billing_interval == "Month":
+				fixed_rate += subscription_total
+
+			elif recurrence_period.billing_interval == "Year":
+				fixed_rate += subscription_total / 12
+
+			elif recurrence_period.billing_interval == "Day":
+				daily_rate += subscription_total
+
+			elif recurrence_period.billing_interval == "Week":
+				daily_rate += subscription_total / 7
+
+		rates[customer] = (fixed_rate, daily_rate)
+
+	return rates
 
 
 def monthdelta(d1, d2):
@@ -146,36 +222,6 @@ def monthdelta(d1, d2):
 	return delta
 
 
-def get_subscription_mrr(subscriptions, period):
-	month_total = 0
-	for subscription in subscriptions:
-		recurrence_period = frappe.get_cached_value(
-			"Recurrence Period",
-			subscription.recurrence_period,
-			["billing_interval", "billing_interval_count"],
-			as_dict=True,
-		)
-
-		if not recurrence_period:
-			continue
-
-		subscription_total = flt(subscription.total) / flt(recurrence_period.billing_interval_count)
-
-		if recurrence_period.billing_interval == "Month":
-			month_total += subscription_total
-
-		elif recurrence_period.billing_interval == "Year":
-			month_total += subscription_total / 12
-
-		elif recurrence_period.billing_interval == "Day":
-			month_total += subscription_total * date_diff(period.to_date, period.from_date)
-
-		elif recurrence_period.billing_interval == "Week":
-			month_total += subscription_total * date_diff(period.to_date, period.from_date) / 7
-
-	return month_total * month_diff(period.to_date, period.from_date)
-
-
 def get_chart_data(columns, data):
 	values = []
 	precision = get_currency_precision() or 2
@@ -0,0 +1,213 @@
+# Copyright (c) 2024, Scopen and Contributors
+# See license.txt
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import (
+	add_days,
+	add_months,
+	date_diff,
+	flt,
+	get_first_day,
+	get_last_day,
+	getdate,
+	month_diff,
+	nowdate,
+)
+
+from erpnext_france.erpnext_france.report.monthly_recurring_revenue.monthly_recurring_revenue import (
+	get_mrr_matrix,
+	monthdelta,
+)
+
+RECURRENCE_PERIODS = {
+	"_Test MRR Monthly": ("Month", 1),
+	"_Test MRR Yearly": ("Year", 1),
+	"_Test MRR Weekly": ("Week", 1),
+	"_Test MRR Every Two Days": ("Day", 2),
+}
+
+
+def get_baseline_mrr(invoices, subscriptions, period):
+	"""Recurring revenue of a customer in a period as computed by the report before the matrix"""
+	total = 0.0
+	for invoice in invoices:
+		if invoice.from_date and invoice.to_date:
+			if (
+				getdate(period.from_date).replace(day=1) >= getdate(invoice.from_date).replace(day=1)
+				and getdate(period.to_date).replace(day=1) <= getdate(invoice.to_date).replace(day=1)
+				and monthdelta(invoice.from_date, invoice.to_date) + 1 > 1
+			):
+				total = flt(invoice.total) / (monthdelta(invoice.from_date, invoice.to_date) + 1)
+				break
+
+			elif period.to_date >= getdate(invoice.posting_date) >= period.from_date and getdate(
+				period.to_date
+			) >= getdate(invoice.from_date):
+				total += flt(invoice.total)
+
+	if total or period.to_date < getdate(nowdate()):
+		return total
+
+	month_total = 0
+	for subscription in subscriptions:
+		recurrence_period = frappe.get_cached_value(
+			"Recurrence Period",
+			subscription.recurrence_period,
+			["billing_interval", "billing_interval_count"],
+			as_dict=True,
+		)
+
+		if not recurrence_period:
+			continue
+
+		subscription_total = flt(subscription.total) / flt(recurrence_period.billing_interval_count)
+
+		if recurrence_period.billing_interval == "Month":
+			month_total += subscription_total
+
+		elif recurrence_period.billing_interval == "Year":
+			month_total += subscription_total / 12
+
+		elif recurrence_period.billing_interval == "Day":
+			month_total += subscription_total * date_diff(period.to_date, period.from_date)
+
+		elif recurrence_period.billing_interval == "Week":
+			month_total += subscription_total * date_diff(period.to_date, period.from_date) / 7
+
+	return month_total * month_diff(period.to_date, period.from_date)
+
+
+def get_periods(months, periodicity=1):
+	"""Periods of `periodicity` months, starting 6 months ago"""
+	start = get_first_day(add_months(nowdate(), -6))
+	return [
+		frappe._dict(
+			key="period_{0}".format(index),
+			from_date=getdate(add_months(start, index * periodicity)),
+			to_date=get_last_day(add_months(start, (index + 1) * periodicity - 1)),
+		)
+		for index in range(months // periodicity)
+	]
+
+
+def get_month(months, day=1):
+	return getdate(add_days(get_first_day(add_months(nowdate(), months)), day - 1))
+
+
+def make_invoice(customer, total, posting_date, from_date=None, to_date=None):
+	return frappe._dict(
+		customer=customer,
+		total=total,
+		posting_date=posting_date,
+		from_date=from_date,
+		to_date=to_date,
+	)
+
+
+def make_subscription(customer, total, recurrence_period):
+	return frappe._dict(customer=customer, total=total, recurrence_period=recurrence_period)
+
+
+class TestMonthlyRecurringRevenue(FrappeTestCase):
+	@classmethod
+	def setUpClass(cls):
+		super().setUpClass()
+		for title, (billing_interval, billing_interval_count) in RECURRENCE_PERIODS.items():
+			if not frappe.db.exists("UOM", billing_interval):
+				frappe.get_doc({"doctype": "UOM", "uom_name": billing_interval}).insert()
+
+			if not frappe.db.exists("Recurrence Period", title):
+				frappe.get_doc(
+					{
+						"doctype": "Recurrence Period",
+						"title": title,
+						"periodicity": billing_interval,
+						"billing_interval": billing_interval,
+						"billing_interval_count": billing_interval_count,
+					}
+				).insert()
+
+	def setUp(self):
+		self.invoices = [
+			# Overlapping invoices spread over several months
+			make_invoice("Spread", 300, get_month(-5, 15), get_month(-5, 15), get_month(-3, 14)),
+			make_invoice("Spread", 400, get_month(-4), get_month(-4), get_last_day(get_month(-1))),
+			# Invoice posted in a period covered by a spread invoice
+			make_invoice("Spread", 50, get_month(-2, 10), get_month(-2, 10), get_month(-2, 10)),
+			# Invoices posted in the same period
+			make_invoice("Spread", 30, get_month(0, 3), get_month(0, 3), get_month(0, 3)),
+			make_invoice("Spread", 20, get_month(0, 8), get_month(0, 8), get_month(0, 8)),
+			# Invoice without service dates
+			make_invoice("Spread", 1000, get_month(1, 5)),
+			# Invoice posted before the periods
+			make_invoice("Spread", 70, get_month(-12), get_month(-12), get_month(-12)),
+			# Invoice with service dates after its posting date
+			make_invoice("Posted", 90, get_month(-1, 20), get_month(0), get_month(0)),
+			make_invoice("Posted", 60, get_month(2, 20), get_month(2, 20), get_month(2, 25)),
+		]
+		self.subscriptions = [
+			make_subscription("Spread", 500, "_Test MRR Monthly"),
+			make_subscription("Posted", 100, "_Test MRR Monthly"),
+			make_subscription("Posted", 24, "_Test MRR Yearly"),
+			make_subscription("Subscribed", 120, "_Test MRR Monthly"),
+			make_subscription("Subscribed", 1200, "_Test MRR Yearly"),
+			make_subscription("Subscribed", 70, "_Test MRR Weekly"),
+			make_subscription("Subscribed", 6, "_Test MRR Every Two Days"),
+			make_subscription("Subscribed", 999, "_Test Missing Recurrence Period"),
+		]
+
+	def assertMatrixMatchesBaseline(self, period_list):
+		invoices_by_customer = {}
+		for invoice in self.invoices:
+			invoices_by_customer.setdefault(invoice.customer, []).append(invoice)
+
+		subscriptions_by_customer = {}
+		for subscription in self.subscriptions:
+			subscriptions_by_customer.setdefault(subscription.customer, []).append(subscription)
+
+		customers = list(dict.fromkeys([*invoices_by_customer, *subscriptions_by_customer]))
+		matrix = get_mrr_matrix(customers, invoices_by_customer, subscriptions_by_customer, period_list)
+
+		self.assertEqual(len(matrix), len(customers))
+		for customer, totals in zip(customers, matrix):
+			self.assertEqual(len(totals), len(period_list))
+			for period, total in zip(period_list, totals):
+				with self.subTest(customer=customer, period=period.from_date):
+					self.assertEqual(
+						flt(total, 6),
+						flt(
+							get_baseline_mrr(
+								invoices_by_customer.get(customer, []),
+								subscriptions_by_customer.get(customer, []),
+								period,
+							),
+							6,
+						),
+					)
+
+		return dict(zip(customers, matrix))
+
+	def test_monthly_periods(self):
+		matrix = self.assertMatrixMatchesBaseline(get_periods(12))
+
+		# The first spread invoice wins over the overlapping one and the invoice posted in its period
+		self.assertEqual(matrix["Spread"][1], 150)
+		self.assertEqual(matrix["Spread"][2], 150)
+		self.assertEqual(matrix["Spread"][4], 100)
+		self.assertEqual(matrix["Spread"][6], 50)
+		self.assertEqual(matrix["Spread"][7], 500)
+
+		# Past periods without invoices get no recurring amount
+		current_month = get_periods(12)[6]
+		self.assertEqual(matrix["Subscribed"][5], 0)
+		self.assertEqual(
+			matrix["Subscribed"][6],
+			120 + 100 + (10 + 3) * date_diff(current_month.to_date, current_month.from_date),
+		)
+
+	def test_quarterly_periods(self):
+		self.assertMatrixMatchesBaseline(get_periods(12, periodicity=3))
+
+	def test_yearly_period(self):
+		self.assertMatrixMatchesBaseline(get_periods(12, periodicity=12))
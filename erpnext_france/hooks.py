@@ -289,8 +289,14 @@ doc_events = {
 		"on_trash": "erpnext_france.utils.transaction_log.check_deletion_permission",
 		"on_submit": "erpnext_france.utils.transaction_log.create_transaction_log"
 	},
+	"Account": {
+		"on_update": "erpnext_france.erpnext_france.report.general_ledger.general_ledger.clear_account_details_cache",
+		"after_rename": "erpnext_france.erpnext_france.report.general_ledger.general_ledger.clear_account_details_cache",
+		"on_trash": "erpnext_france.erpnext_france.report.general_ledger.general_ledger.clear_account_details_cache",
+	},
 	"GL Entry": {
-		"on_submit": "erpnext_france.utils.accounting_entry_number.add_accounting_entry_number",
+		"before_submit": "erpnext_france.utils.accounting_entry_number.set_accounting_entry_number",
+		"on_submit": "erpnext_france.utils.balance_snapshot.invalidate_gl_entry",
 	},
 	"Payment Ledger Entry": {
 		"on_update": "erpnext_france.controllers.ple_down_payment.on_update"
@@ -299,7 +305,8 @@ doc_events = {
 		"validate": "erpnext_france.controllers.journal_entry_down_payment.validate"
 	},
 	"Company": {
-		"after_insert": "erpnext_france.setup.setup_company_default"
+		"after_insert": "erpnext_france.setup.setup_company_default",
+		"validate": "erpnext_france.erpnext_france.doctype.accounting_export.export_formats.validate_export_file_format"
 	},
 	"System Settings":{
 		# "on_update": 'erpnext_france.install.after_wizard'
@@ -327,6 +334,12 @@ doc_events = {
 # 	]
 # }
 
+scheduler_events = {
+	"monthly_long": [
+		"erpnext_france.utils.balance_snapshot.rebuild_ready_balance_snapshots",
+	],
+}
+
 # Testing
 # -------
 
@@ -348,6 +361,15 @@ regional_overrides = {
 	},
 }
 
+# Accounting Export Formats
+# -------------------------
+# Formats of the accounting export by Company export file format, other apps can add theirs
+
+accounting_export_formats = {
+	"CIEL": "erpnext_france.erpnext_france.doctype.accounting_export.export_formats.CielFormat",
+	"SAGE": "erpnext_france.erpnext_france.doctype.accounting_export.export_formats.SageFormat",
+}
+
 # DocType Class
 # ---------------
 # Override standard doctype classes
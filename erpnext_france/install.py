@@ -5,9 +5,12 @@
 import frappe
 from frappe.custom.doctype.custom_field.custom_field import create_custom_fields
 
+from erpnext_france.utils.indexes import add_indexes
+
 def after_install():
 	add_custom_roles_for_reports()
 	set_accounting_journal_as_mandatory()
+	add_indexes()
 
 # TODO : Trouver comment faire pour desactiver enable_onboarding juste après le wizard
 # TODO : Actuellement c'est la dernière action qu'il effectue après avoir executé les hooks setup_wizard_*
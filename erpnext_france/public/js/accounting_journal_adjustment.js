@@ -5,6 +5,7 @@
 erpnext.journalAdjustment = class AccountingJournalAdjustment {
 	constructor(opts) {
 		Object.assign(this, opts);
+		this.on_adjustment_done = this.on_adjustment_done.bind(this);
 		this.make()
 	}
 
@@ -27,12 +28,16 @@ erpnext.journalAdjustment = class AccountingJournalAdjustment {
 				}
 			],
 			primary_action: function() {
-				frappe.xcall('erpnext_france.erpnext_france.doctype.accounting_journal.accounting_journal.accounting_journal_adjustment', {
+				// Listen before enqueueing, so that a short adjustment is not missed
+				frappe.realtime.on('accounting_journal_adjustment', me.on_adjustment_done);
+				frappe.xcall('erpnext_france.erpnext_france.doctype.accounting_journal.accounting_journal.enqueue_accounting_journal_adjustment', {
 					doctype: me.doctype,
 					docnames: me.docnames,
 					accounting_journal: me.dialog.get_values().new_journal
 				}).then(() => {
 					frappe.show_alert({message: __('Accounting Journal adjustment in progress'), indicator: 'green'});
+				}).catch(() => {
+					frappe.realtime.off('accounting_journal_adjustment', me.on_adjustment_done);
 				})
 				me.dialog.hide();
 			},
@@ -42,6 +47,27 @@ erpnext.journalAdjustment = class AccountingJournalAdjustment {
 		this.get_accounting_entries();
 	}
 
+	on_adjustment_done(data) {
+		frappe.realtime.off('accounting_journal_adjustment', this.on_adjustment_done);
+		frappe.hide_progress();
+
+		if (data.failed) {
+			frappe.msgprint({
+				title: __('Accounting Journal adjustment failed'),
+				message: __('{0} of {1} documents were adjusted. The error is recorded in the Error Log.', [data.adjusted, data.docnames.length]),
+				indicator: 'red'
+			});
+		} else {
+			frappe.show_alert({message: __('Accounting Journal adjustment completed'), indicator: 'green'});
+		}
+
+		if (window.cur_list && cur_list.doctype === data.doctype) {
+			cur_list.refresh();
+		} else if (window.cur_frm && cur_frm.doctype === data.doctype && data.docnames.includes(cur_frm.docname)) {
+			cur_frm.reload_doc();
+		}
+	}
+
 	get_accounting_entries() {
 		frappe.xcall('erpnext_france.erpnext_france.doctype.accounting_journal.accounting_journal.get_entries', {
 			doctype: this.doctype,
@@ -10,6 +10,14 @@ frappe.ui.form.on("Company", {
                     }
                 };
             });
+        },
+        onload: function (frm) {
+            // formats are registered by the accounting_export_formats hook, other apps can add theirs
+            frappe.xcall(
+                'erpnext_france.erpnext_france.doctype.accounting_export.export_formats.get_export_format_names'
+            ).then((formats) => {
+                frm.set_df_property('export_file_format', 'options', formats);
+            });
         }
     }
 );
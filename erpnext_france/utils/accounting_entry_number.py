@@ -1,50 +1,113 @@
 # Copyright (c) 2023, Scopen and contributors
 # For license information, please see license.txt
 
+import time
+import unicodedata
+from functools import lru_cache
+
 import frappe
 from frappe import _
-from frappe.model.naming import make_autoname
-from frappe.utils import cint
+from frappe.query_builder import Case
+from frappe.query_builder.functions import IfNull, Max, Min
+from frappe.utils import cint, getdate
+from frappe.utils.safe_exec import WHITELISTED_SAFE_EVAL_GLOBALS, _validate_safe_eval_syntax
+
+JOURNAL_RULES_CACHE_KEY = "accounting_journal_rules"
+BACKFILL_CHUNK_SIZE = 1000
 
-def add_accounting_entry_number(gl_entry, action):
+def set_accounting_entry_number(gl_entry, action):
+	"""Number the GL Entry before it is inserted, with the number and journal of its voucher"""
 	if gl_entry.accounting_entry_number:
 		return
 
-	linked_gl_entries = frappe.get_all(
-		'GL Entry',
-		fields={"name", "accounting_entry_number"},
-		filters={"voucher_no": gl_entry.voucher_no}
+	numbering = get_voucher_numbering(gl_entry)
+	gl_entry.accounting_entry_number = numbering.accounting_entry_number
+	gl_entry.accounting_journal = numbering.accounting_journal
+
+def get_voucher_numbering(gl_entry):
+	"""
+	Return the accounting entry number and journal of the voucher of the GL Entry, resolved on
+	its first GL Entry. They are posted one voucher after the other, so only the last voucher is kept.
+
+	A new voucher is numbered when the transaction is committed, see `number_pending_vouchers`.
+	"""
+	numbering = getattr(frappe.local, "accounting_entry_numbering", None)
+	if numbering and numbering.key == (gl_entry.voucher_type, gl_entry.voucher_no):
+		return numbering
+
+	gl_entry.accounting_entry_number = frappe.db.get_value(
+		"GL Entry",
+		{"voucher_no": gl_entry.voucher_no, "accounting_entry_number": ("is", "set")},
+		"accounting_entry_number",
+	)
+	if not gl_entry.accounting_entry_number:
+		add_pending_voucher(gl_entry)
+
+	numbering = frappe.local.accounting_entry_numbering = frappe._dict(
+		key=(gl_entry.voucher_type, gl_entry.voucher_no),
+		accounting_entry_number=gl_entry.accounting_entry_number,
+		accounting_journal=get_accounting_journal(gl_entry),
 	)
+	frappe.db.after_rollback.add(clear_voucher_numbering)
 
-	accounting_entry_number = ''
-	for linked_gl_entry in linked_gl_entries:
-		if linked_gl_entry.name == gl_entry.name:
-			continue
+	return numbering
 
-		if linked_gl_entry.accounting_entry_number:
-			accounting_entry_number = linked_gl_entry.accounting_entry_number
+def clear_voucher_numbering():
+	frappe.local.accounting_entry_numbering = None
+	frappe.local.pending_accounting_vouchers = {}
 
-	if not accounting_entry_number:
-		accounting_entry_number = get_accounting_number(gl_entry)
+def add_pending_voucher(gl_entry):
+	pending_vouchers = getattr(frappe.local, "pending_accounting_vouchers", None) or {}
+	if not pending_vouchers:
+		frappe.db.before_commit.add(number_pending_vouchers)
 
-	gl_entry.accounting_entry_number = accounting_entry_number
-	gl_entry.accounting_journal = get_accounting_journal(gl_entry)
+	pending_vouchers.setdefault((gl_entry.voucher_type, gl_entry.voucher_no), gl_entry.fiscal_year)
+	frappe.local.pending_accounting_vouchers = pending_vouchers
 
-	gl_entry.save()
+def number_pending_vouchers():
+	"""
+	Number the vouchers posted in the transaction, just before it is committed
 
-def get_accounting_journal(entry):
-	rules = frappe.get_all(
-		"Accounting Journal",
-		filters={"company": entry.company, "disabled": 0},
-		fields=[
-			"name",
-			"type",
-			"account",
-			"`tabAccounting Journal Rule`.document_type",
-			"`tabAccounting Journal Rule`.condition",
-		],
+	The series of the fiscal year stays locked from the allocation to the end of the transaction:
+	allocating all the numbers of the transaction at commit time keeps this lock short, while the
+	numbers stay gap-free and follow the commit order.
+	"""
+	pending_vouchers = getattr(frappe.local, "pending_accounting_vouchers", None) or {}
+	clear_voucher_numbering()
+	if not pending_vouchers:
+		return
+
+	gle = frappe.qb.DocType("GL Entry")
+	# Vouchers rolled back to a savepoint have no GL Entries left to number
+	unnumbered_vouchers = set(
+		(
+			frappe.qb.from_(gle)
+			.select(gle.voucher_type, gle.voucher_no)
+			.distinct()
+			.where(gle.voucher_no.isin([voucher_no for _voucher_type, voucher_no in pending_vouchers]))
+			.where(IfNull(gle.accounting_entry_number, "") == "")
+		).run()
 	)
 
+	vouchers_by_fiscal_year = {}
+	for voucher, fiscal_year in pending_vouchers.items():
+		if voucher in unnumbered_vouchers:
+			vouchers_by_fiscal_year.setdefault(fiscal_year, []).append(voucher)
+
+	for fiscal_year, vouchers in sorted(vouchers_by_fiscal_year.items()):
+		numbers = get_accounting_numbers(fiscal_year, len(vouchers))
+		for (voucher_type, voucher_no), accounting_entry_number in zip(vouchers, numbers):
+			(
+				frappe.qb.update(gle)
+				.set(gle.accounting_entry_number, accounting_entry_number)
+				.where(gle.voucher_type == voucher_type)
+				.where(gle.voucher_no == voucher_no)
+				.where(IfNull(gle.accounting_entry_number, "") == "")
+			).run()
+
+def get_accounting_journal(entry):
+	rules = get_journal_rules(entry.company)
+
 	applicable_rules = [
 		rule for rule in rules if (rule.account in (entry.account, entry.against, None))
 	]
@@ -60,11 +123,7 @@ def get_accounting_journal(entry):
 
 	accounting_journal = ''
 	for condition in [rule for rule in applicable_rules if rule.condition]:
-		if frappe.safe_eval(
-				condition.condition,
-				None,
-				{"doc": frappe.get_doc(entry.voucher_type, entry.voucher_no).as_dict()},
-		):
+		if evaluate_voucher_condition(entry.voucher_type, entry.voucher_no, condition.condition):
 			accounting_journal = condition.name
 			break
 
@@ -73,7 +132,7 @@ def get_accounting_journal(entry):
 	]:
 		accounting_journal = [rule for rule in applicable_rules if not rule.condition][0].name
 
-	if not accounting_journal:
+	if not accounting_journal and entry.accounting_entry_number:
 		accounting_journal = frappe.db.get_value(
 			"GL Entry",
 			dict(accounting_entry_number=entry.accounting_entry_number),
@@ -91,6 +150,247 @@ def get_accounting_journal(entry):
 
 	return accounting_journal
 
-def get_accounting_number(doc: dict) -> str:
-	return make_autoname(_("AEN-.fiscal_year.-.#########"), "GL Entry", doc)
+def get_journal_rules(company):
+	"""Return the enabled journal rules of the company, cached until an Accounting Journal changes"""
+	return frappe.cache().hget(
+		JOURNAL_RULES_CACHE_KEY,
+		company,
+		lambda: frappe.get_all(
+			"Accounting Journal",
+			filters={"company": company, "disabled": 0},
+			fields=[
+				"name",
+				"type",
+				"account",
+				"`tabAccounting Journal Rule`.document_type",
+				"`tabAccounting Journal Rule`.condition",
+			],
+		),
+	)
+
+
+def clear_journal_rules_cache():
+	frappe.cache().delete_key(JOURNAL_RULES_CACHE_KEY)
+
+
+@lru_cache(maxsize=None)
+def compile_condition(condition):
+	condition = unicodedata.normalize("NFKC", condition)
+	_validate_safe_eval_syntax(condition)
+	return compile(condition, "<accounting journal condition>", "eval")
+
+
+def evaluate_condition(condition, doc):
+	"""Evaluate a journal rule condition like frappe.safe_eval, compiling it only once"""
+	eval_globals = {"__builtins__": {}}
+	eval_globals.update(WHITELISTED_SAFE_EVAL_GLOBALS)
+	return eval(compile_condition(condition), eval_globals, {"doc": doc})
+
+
+def evaluate_voucher_condition(voucher_type, voucher_no, condition):
+	"""
+	Evaluate a condition on a voucher, loading it and evaluating the condition once for all its
+	GL Entries. They are posted one voucher after the other, so only the last voucher is kept.
+	"""
+	voucher = getattr(frappe.local, "accounting_journal_voucher", None)
+	if not voucher or voucher.key != (voucher_type, voucher_no):
+		voucher = frappe.local.accounting_journal_voucher = frappe._dict(
+			key=(voucher_type, voucher_no),
+			doc=frappe.get_doc(voucher_type, voucher_no).as_dict(),
+			conditions={},
+		)
+
+	if condition not in voucher.conditions:
+		voucher.conditions[condition] = evaluate_condition(condition, voucher.doc)
+
+	return voucher.conditions[condition]
+
+
+def get_accounting_numbers(fiscal_year, count):
+	"""
+	Allocate a block of consecutive accounting entry numbers of the fiscal year, in the same series
+	as `make_autoname("AEN-.fiscal_year.-.#########")` with one update of the series
+
+	The series row stays locked until the end of the transaction: the callers allocate the
+	numbers of several fiscal years in sorted order, so that concurrent transactions do not deadlock.
+	"""
+	prefix = "AEN-{0}-".format(fiscal_year)
+	series = frappe.qb.DocType("Series")
+	current = (
+		frappe.qb.from_(series).select(series.current).where(series.name == prefix).for_update()
+	).run()
+
+	if current:
+		current = cint(current[0][0])
+	else:
+		frappe.qb.into(series).columns(series.name, series.current).insert(prefix, 0).run()
+		current = 0
+
+	frappe.qb.update(series).set(series.current, current + count).where(series.name == prefix).run()
+
+	return ["{0}{1:09d}".format(prefix, number) for number in range(current + 1, current + count + 1)]
+
+
+
+@frappe.whitelist()
+def enqueue_backfill(company, from_date=None, to_date=None):
+	frappe.only_for(("Accounts Manager", "System Manager"))
+	frappe.enqueue(
+		backfill_accounting_entry_numbers,
+		queue="long",
+		timeout=14400,
+		company=company,
+		from_date=from_date,
+		to_date=to_date,
+	)
+
+
+def backfill_accounting_entry_numbers(
+	company, from_date=None, to_date=None, chunk_size=BACKFILL_CHUNK_SIZE, progress=None
+):
+	"""
+	Fill the missing accounting entry numbers and journals of the GL Entries of a company
+
+	The vouchers are numbered in posting order, by chunks of `chunk_size` vouchers each committed,
+	so that an interrupted backfill is started again from the vouchers still missing a number.
+	`progress` is called with the result after each chunk, it logs the progress by default.
+	"""
+	progress = progress or log_backfill_progress
+	start = time.monotonic()
+	gle = frappe.qb.DocType("GL Entry")
+	query = (
+		frappe.qb.from_(gle)
+		.select(gle.posting_date, gle.voucher_no, gle.voucher_type, Min(gle.name).as_("gl_entry"))
+		.where(gle.company == company)
+		.where(
+			(IfNull(gle.accounting_entry_number, "") == "") | (IfNull(gle.accounting_journal, "") == "")
+		)
+		.groupby(gle.posting_date, gle.voucher_no, gle.voucher_type)
+		.orderby(gle.posting_date)
+		.orderby(gle.voucher_no)
+		.orderby(gle.voucher_type)
+		.limit(chunk_size)
+	)
+	if from_date:
+		query = query.where(gle.posting_date >= getdate(from_date))
+	if to_date:
+		query = query.where(gle.posting_date <= getdate(to_date))
+
+	result = frappe._dict(vouchers=0, without_journal=0, duration=0)
+	chunk_query = query
+	while vouchers := chunk_query.run(as_dict=True):
+		result.without_journal += backfill_vouchers(vouchers)
+		result.vouchers += len(vouchers)
+		frappe.db.commit()
+		# Vouchers without journal leave their validation message, they are counted instead
+		frappe.clear_messages()
+
+		result.duration = round(time.monotonic() - start, 3)
+		progress(result)
+
+		# Vouchers left without journal stay in the selection, so the next chunk starts after the last one
+		last = vouchers[-1]
+		chunk_query = query.where(
+			(gle.posting_date > last.posting_date)
+			| ((gle.posting_date == last.posting_date) & (gle.voucher_no > last.voucher_no))
+			| (
+				(gle.posting_date == last.posting_date)
+				& (gle.voucher_no == last.voucher_no)
+				& (gle.voucher_type > last.voucher_type)
+			)
+		)
+
+	return result
+
+
+def log_backfill_progress(result):
+	frappe.logger("accounting_entry_number").info(
+		"{0} vouchers backfilled in {1}s ({2} vouchers/s), {3} left without journal".format(
+			result.vouchers,
+			result.duration,
+			round(result.vouchers / (result.duration or 1)),
+			result.without_journal,
+		)
+	)
+
+
+def backfill_vouchers(vouchers):
+	"""
+	Number a chunk of vouchers and set their journals, returning the count left without journal
+
+	The lines of a voucher missing a number or a journal get the ones of the other lines of the
+	voucher when it has them, or else a new number and the journal resolved on its first line.
+	"""
+	gle = frappe.qb.DocType("GL Entry")
+	voucher_nos = list({voucher.voucher_no for voucher in vouchers})
+	voucher_numbers = {
+		(row.voucher_type, row.voucher_no): row
+		for row in (
+			frappe.qb.from_(gle)
+			.select(
+				gle.voucher_type,
+				gle.voucher_no,
+				Max(gle.accounting_entry_number).as_("accounting_entry_number"),
+				Max(gle.accounting_journal).as_("accounting_journal"),
+			)
+			.where(gle.voucher_no.isin(voucher_nos))
+			.groupby(gle.voucher_type, gle.voucher_no)
+		).run(as_dict=True)
+	}
+	first_entries = {
+		row.name: row
+		for row in frappe.get_all(
+			"GL Entry",
+			filters={"name": ("in", [voucher.gl_entry for voucher in vouchers])},
+			fields=["name", "company", "account", "against", "voucher_type", "voucher_no", "fiscal_year"],
+		)
+	}
+
+	entries = {}
+	for voucher in vouchers:
+		# A voucher posted on several dates is grouped once per date
+		key = (voucher.voucher_type, voucher.voucher_no)
+		if key not in entries:
+			entry = entries[key] = first_entries[voucher.gl_entry]
+			entry.accounting_entry_number = voucher_numbers[key].accounting_entry_number
+			entry.accounting_journal = voucher_numbers[key].accounting_journal
+
+	entries_by_fiscal_year = {}
+	for entry in entries.values():
+		if not entry.accounting_entry_number:
+			entries_by_fiscal_year.setdefault(entry.fiscal_year, []).append(entry)
+
+	for fiscal_year, fiscal_year_entries in sorted(entries_by_fiscal_year.items()):
+		accounting_entry_numbers = get_accounting_numbers(fiscal_year, len(fiscal_year_entries))
+		for entry, accounting_entry_number in zip(fiscal_year_entries, accounting_entry_numbers):
+			entry.accounting_entry_number = accounting_entry_number
+
+	without_journal = 0
+	for entry in entries.values():
+		if not entry.accounting_journal:
+			try:
+				entry.accounting_journal = get_accounting_journal(entry)
+			except frappe.ValidationError:
+				entry.accounting_journal = None
+
+			if not entry.accounting_journal:
+				without_journal += 1
+
+	for fieldname in ("accounting_entry_number", "accounting_journal"):
+		values, value_vouchers = Case().else_(gle[fieldname]), set()
+		for (voucher_type, voucher_no), entry in entries.items():
+			if entry.get(fieldname):
+				values = values.when(
+					(gle.voucher_type == voucher_type) & (gle.voucher_no == voucher_no), entry.get(fieldname)
+				)
+				value_vouchers.add(voucher_no)
+
+		if value_vouchers:
+			(
+				frappe.qb.update(gle)
+				.set(gle[fieldname], values)
+				.where(gle.voucher_no.isin(list(value_vouchers)))
+				.where(IfNull(gle[fieldname], "") == "")
+			).run()
 
+	return without_journal
@@ -0,0 +1,242 @@
+# Copyright (c) 2024, Scopen and contributors
+# For license information, please see license.txt
+
+import datetime
+import hashlib
+
+import frappe
+from frappe.query_builder.functions import Min, Sum
+from frappe.utils import add_months, flt, get_first_day, getdate, now, nowdate
+from pypika.enums import DatePart
+from pypika.functions import Extract
+
+SNAPSHOT_CHUNK_SIZE = 1000
+SNAPSHOTS_HORIZON_KEY = "account_balance_snapshots_horizon"
+# Horizon of the snapshots being built: they are not used yet
+MIN_SNAPSHOTS_HORIZON = "1900-01-01"
+
+
+def invalidate_gl_entry(gl_entry, action):
+	invalidate_snapshots([gl_entry])
+
+	if gl_entry.is_cancelled:
+		# The cancelled entries of the voucher leave the ledger in their own months
+		gle = frappe.qb.DocType("GL Entry")
+		first_posting_date = (
+			frappe.qb.from_(gle)
+			.select(Min(gle.posting_date))
+			.where(gle.voucher_type == gl_entry.voucher_type)
+			.where(gle.voucher_no == gl_entry.voucher_no)
+		).run()[0][0]
+		if first_posting_date:
+			invalidate_snapshots([{"company": gl_entry.company, "posting_date": first_posting_date}])
+
+
+def invalidate_snapshots(gl_entries):
+	"""
+	Move the horizon of the snapshots back before the months of the GL Entries, when the
+	transaction is committed
+
+	The snapshots are only read for the months before the horizon, so the entries posted,
+	reposted or changed in these months are read from the ledger until the next rebuild.
+	The entries of the current month are never before the horizon.
+	"""
+	pending_horizons = getattr(frappe.local, "pending_snapshot_horizons", None) or {}
+	current_month = get_first_day(nowdate())
+	horizons = {}
+	for gl_entry in gl_entries:
+		month = get_first_day(gl_entry.get("posting_date"))
+		company = gl_entry.get("company")
+		if month < current_month and month < horizons.get(company, current_month):
+			horizons[company] = month
+
+	if not horizons:
+		return
+
+	if not pending_horizons:
+		frappe.db.before_commit.add(write_pending_horizons)
+		frappe.db.after_rollback.add(clear_pending_horizons)
+
+	for company, month in horizons.items():
+		pending_horizons[company] = min(month, pending_horizons.get(company, month))
+
+	frappe.local.pending_snapshot_horizons = pending_horizons
+
+
+def clear_pending_horizons():
+	frappe.local.pending_snapshot_horizons = {}
+
+
+def write_pending_horizons():
+	"""
+	Move the horizons back just before the transaction is committed, so that they stay locked briefly
+
+	A horizon is only ever moved back here, and it is locked by a rebuild until it is committed:
+	the entries of the transaction are either read by the rebuild or left after the horizon.
+	Months rolled back to a savepoint may still move the horizon back, which is harmless.
+	"""
+	pending_horizons = getattr(frappe.local, "pending_snapshot_horizons", None) or {}
+	clear_pending_horizons()
+	for company, month in sorted(pending_horizons.items()):
+		frappe.db.sql(
+			"""
+			update `tabDefaultValue`
+			set defvalue = least(defvalue, %s)
+			where parent = %s and defkey = %s
+			""",
+			(str(month), company, SNAPSHOTS_HORIZON_KEY),
+		)
+
+
+def get_snapshot_key(gl_entry):
+	return (
+		gl_entry.get("company"),
+		gl_entry.get("account"),
+		gl_entry.get("party_type") or "",
+		gl_entry.get("party") or "",
+		gl_entry.get("finance_book") or "",
+		get_first_day(gl_entry.get("posting_date")),
+	)
+
+
+def get_snapshot_name(key):
+	"""The name is derived from the key, so that the primary key makes each snapshot unique"""
+	return hashlib.sha1("|".join(str(value) for value in key).encode()).hexdigest()
+
+
+def upsert_snapshots(balances):
+	"""Add the {key: [debit, credit]} balances to their snapshots, creating the missing ones"""
+	timestamp = now()
+	balances = list(balances.items())
+	for i in range(0, len(balances), SNAPSHOT_CHUNK_SIZE):
+		values = [
+			(get_snapshot_name(key), timestamp, timestamp, frappe.session.user, frappe.session.user, *key, debit, credit)
+			for key, (debit, credit) in balances[i : i + SNAPSHOT_CHUNK_SIZE]
+		]
+		frappe.db.sql(
+			"""
+			insert into `tabAccount Balance Snapshot`
+				(name, creation, modified, owner, modified_by,
+				company, account, party_type, party, finance_book, month, debit, credit)
+			values {0}
+			on duplicate key update
+				debit = debit + values(debit),
+				credit = credit + values(credit),
+				modified = values(modified)
+			""".format(", ".join(["%s"] * len(values))),
+			values,
+		)
+
+
+def rebuild_balance_snapshots(company=None):
+	"""
+	Rebuild the snapshots of a company, or of all of them, from the GL Entries, up to the
+	month before the current one
+
+	The horizon stays locked during the rebuild, so that the entries posted meanwhile in the
+	months it covers move it back once the rebuild is committed.
+
+	Run with `bench --site <site> rebuild-balance-snapshots [--company <company>]`
+	"""
+	companies = [company] if company else frappe.get_all("Company", pluck="name")
+	gle = frappe.qb.DocType("GL Entry")
+	snapshot = frappe.qb.DocType("Account Balance Snapshot")
+	default_value = frappe.qb.DocType("DefaultValue")
+
+	for company in companies:
+		if get_snapshots_horizon(company) is None:
+			frappe.db.set_default(SNAPSHOTS_HORIZON_KEY, MIN_SNAPSHOTS_HORIZON, parent=company)
+
+		# The ledger is read in a new transaction, once the horizon is locked
+		frappe.db.commit()
+		(
+			frappe.qb.from_(default_value)
+			.select(default_value.defvalue)
+			.where(default_value.parent == company)
+			.where(default_value.defkey == SNAPSHOTS_HORIZON_KEY)
+			.for_update()
+		).run()
+		frappe.qb.from_(snapshot).delete().where(snapshot.company == company).run()
+
+		balances = {}
+		for row in (
+			frappe.qb.from_(gle)
+			.select(
+				gle.company,
+				gle.account,
+				gle.party_type,
+				gle.party,
+				gle.finance_book,
+				Extract(DatePart.year, gle.posting_date).as_("year"),
+				Extract(DatePart.month, gle.posting_date).as_("month"),
+				Sum(gle.debit).as_("debit"),
+				Sum(gle.credit).as_("credit"),
+			)
+			.where(gle.company == company)
+			.where(gle.is_cancelled == 0)
+			.groupby(
+				gle.account,
+				gle.party_type,
+				gle.party,
+				gle.finance_book,
+				Extract(DatePart.year, gle.posting_date),
+				Extract(DatePart.month, gle.posting_date),
+			)
+		).run(as_dict=True):
+			row.posting_date = datetime.date(int(row.year), int(row.month), 1)
+			balance = balances.setdefault(get_snapshot_key(row), [0.0, 0.0])
+			balance[0] += flt(row.debit)
+			balance[1] += flt(row.credit)
+
+		upsert_snapshots(balances)
+		# Entries of the previous month may still be posted by transactions started before the rebuild
+		frappe.db.set_default(
+			SNAPSHOTS_HORIZON_KEY, str(get_first_day(add_months(nowdate(), -1))), parent=company
+		)
+		frappe.db.commit()
+
+
+def rebuild_ready_balance_snapshots():
+	"""Move the horizons forward each month, rebuilding the snapshots of the companies using them"""
+	for company in frappe.get_all("Company", pluck="name"):
+		if snapshots_ready(company):
+			rebuild_balance_snapshots(company)
+
+
+def get_snapshots_horizon(company):
+	"""Return the month before which the snapshots match the ledger, read from the database as it is not cached"""
+	default_value = frappe.qb.DocType("DefaultValue")
+	horizon = (
+		frappe.qb.from_(default_value)
+		.select(default_value.defvalue)
+		.where(default_value.parent == company)
+		.where(default_value.defkey == SNAPSHOTS_HORIZON_KEY)
+	).run()
+
+	return getdate(horizon[0][0]) if horizon else None
+
+
+def snapshots_ready(company):
+	horizon = get_snapshots_horizon(company)
+	return bool(horizon and horizon > getdate(MIN_SNAPSHOTS_HORIZON))
+
+
+def get_snapshot_balance(company, before_month, accounts=None, party_types=None, parties=None, finance_books=None):
+	"""Return the balance (debit - credit) of the snapshots of the months before `before_month`"""
+	snapshot = frappe.qb.DocType("Account Balance Snapshot")
+	query = (
+		frappe.qb.from_(snapshot)
+		.select(Sum(snapshot.debit) - Sum(snapshot.credit))
+		.where(snapshot.company == company)
+		.where(snapshot.month < before_month)
+	)
+	if accounts:
+		query = query.where(snapshot.account.isin(accounts))
+	if party_types:
+		query = query.where(snapshot.party_type.isin(party_types))
+	if parties:
+		query = query.where(snapshot.party.isin(parties))
+	if finance_books is not None:
+		query = query.where(snapshot.finance_book.isin(finance_books))
+
+	return flt(query.run()[0][0])
@@ -0,0 +1,489 @@
+# Copyright (c) 2024, Scopen and contributors
+# For license information, please see license.txt
+
+import os
+import re
+from itertools import islice
+
+import frappe
+from frappe import _
+from frappe.query_builder import Case
+from frappe.query_builder.functions import Count, IfNull, Max, Sum
+from frappe.utils import add_days, cint, format_datetime, get_last_day, getdate, now_datetime
+from pypika import Order
+
+FEC_FIELDS = (
+	"JournalCode",
+	"JournalLib",
+	"EcritureNum",
+	"EcritureDate",
+	"CompteNum",
+	"CompteLib",
+	"CompAuxNum",
+	"CompAuxLib",
+	"PieceRef",
+	"EcritureLib",
+	"Debit",
+	"Credit",
+	"EcritureLet",
+	"DateLet",
+	"ValidDate",
+	"Montantdevise",
+	"Idevise",
+)
+
+FEC_SEPARATOR = "|"
+CHUNK_SIZE = 5000
+
+
+def get_gl_entries_query(company, fiscal_year, from_date, to_date, hide_already_exported):
+	company_doc = frappe.get_doc('Company', company)
+	gle = frappe.qb.DocType("GL Entry")
+
+	query = (
+		frappe.qb.from_(gle)
+		.select(
+			gle.posting_date.as_("GlPostDate"),
+			gle.name.as_("GlName"),
+			gle.account,
+			gle.transaction_date,
+			gle.export_date.as_("ExportDate"),
+			gle.debit,
+			gle.credit,
+			gle.debit_in_account_currency.as_("debitCurr"),
+			gle.credit_in_account_currency.as_("creditCurr"),
+			gle.accounting_entry_number,
+			gle.voucher_type,
+			gle.voucher_no,
+			gle.against_voucher_type,
+			gle.against_voucher,
+			gle.account_currency,
+			gle.against,
+			gle.party_type,
+			gle.party,
+			gle.accounting_journal,
+			gle.remarks,
+		)
+	)
+
+	query = apply_export_filters(
+		query, gle, company, fiscal_year, from_date, to_date, hide_already_exported
+	)
+
+	current_order = Order.desc
+	if company_doc.type_export_fec == "Standard FEC Export":
+		current_order = Order.asc
+
+	query = (
+		query.orderby(gle.posting_date, order=current_order)
+		.orderby(gle.voucher_no, gle.accounting_entry_number)
+	)
+
+	return query
+
+
+def get_gl_entries(company, fiscal_year, from_date, to_date, hide_already_exported):
+	return get_gl_entries_query(
+		company, fiscal_year, from_date, to_date, hide_already_exported
+	).run(as_dict=True)
+
+
+def apply_export_filters(query, gle, company, fiscal_year, from_date, to_date, hide_already_exported):
+	return query.where(
+		get_export_conditions(gle, company, fiscal_year, from_date, to_date, hide_already_exported)
+	)
+
+
+def get_export_conditions(gle, company, fiscal_year, from_date, to_date, hide_already_exported):
+	conditions = (
+		(gle.company == company)
+		& (gle.fiscal_year == fiscal_year)
+		& (gle.posting_date >= from_date)
+		& (gle.posting_date <= to_date)
+	)
+
+	if hide_already_exported:
+		conditions &= gle.export_date.isnull()
+
+	return conditions
+
+
+class LettrageResolver:
+	"""
+	Resolve the DateLet of the exported entries from one grouped query
+
+	The lettrage date is the latest posting date of the exported entries sharing the same
+	(against_voucher_type, against_voucher, party) when there are several of them, or else
+	the latest posting date of all the entries of the ledger sharing this reference.
+	"""
+
+	def __init__(self, company, fiscal_year, from_date, to_date, hide_already_exported, partition=None):
+		self.dates = {}
+
+		# Only the references of the partition are resolved, against the whole export
+		partition_from_date, partition_to_date = partition or (from_date, to_date)
+		gle = frappe.qb.DocType("GL Entry")
+		references = (
+			apply_export_filters(
+				frappe.qb.from_(gle)
+				.select(gle.against_voucher_type, gle.against_voucher, IfNull(gle.party, "").as_("party"))
+				.distinct()
+				.where(IfNull(gle.against_voucher, "") != ""),
+				gle, company, fiscal_year, partition_from_date, partition_to_date, hide_already_exported
+			)
+		).as_("reference")
+
+		ledger = frappe.qb.DocType("GL Entry", alias="ledger")
+		exported = get_export_conditions(
+			ledger, company, fiscal_year, from_date, to_date, hide_already_exported
+		)
+		lettered = (
+			frappe.qb.from_(ledger)
+			.inner_join(references)
+			.on(
+				(ledger.against_voucher == references.against_voucher)
+				& (ledger.against_voucher_type == references.against_voucher_type)
+				& (IfNull(ledger.party, "") == references.party)
+			)
+			.select(
+				ledger.against_voucher_type,
+				ledger.against_voucher,
+				IfNull(ledger.party, "").as_("party"),
+				Max(ledger.posting_date).as_("ledger_date"),
+				Max(Case().when(exported, ledger.posting_date)).as_("exported_date"),
+				Sum(Case().when(exported, 1).else_(0)).as_("exported_entries"),
+			)
+			.groupby(ledger.against_voucher_type, ledger.against_voucher, IfNull(ledger.party, ""))
+			.having(Count(ledger.name) > 1)
+		)
+
+		for d in lettered.run(as_dict=True):
+			date_let = d.exported_date if d.exported_entries > 1 else d.ledger_date
+			self.dates[(d.against_voucher_type, d.against_voucher, d.party)] = format_datetime(
+				date_let, "yyyyMMdd"
+			)
+
+	def get_date_let(self, d):
+		return self.dates.get((d.get("against_voucher_type"), d.get("against_voucher"), d.get("party") or ""))
+
+
+class FECLabels:
+	"""
+	Titles of the vouchers and names of the parties of an export
+
+	They are loaded with one query per voucher type and per party type, restricted to
+	the entries of the export, instead of joining every document table on each GL row.
+	"""
+
+	title_doctypes = ("Sales Invoice", "Purchase Invoice", "Journal Entry", "Payment Entry")
+	party_name_fields = {
+		"Customer": "customer_name",
+		"Supplier": "supplier_name",
+		"Employee": "employee_name",
+	}
+
+	def __init__(self, company, fiscal_year, from_date, to_date, hide_already_exported):
+		gle = frappe.qb.DocType("GL Entry")
+		export_filters = (company, fiscal_year, from_date, to_date, hide_already_exported)
+
+		self.titles = {}
+		for doctype in self.title_doctypes:
+			voucher = frappe.qb.DocType(doctype)
+			vouchers = apply_export_filters(
+				frappe.qb.from_(gle).select(gle.voucher_no).distinct().where(gle.voucher_type == doctype),
+				gle, *export_filters
+			)
+			self.titles[doctype] = dict(
+				frappe.qb.from_(voucher)
+				.select(voucher.name, voucher.title)
+				.where(voucher.name.isin(vouchers))
+				.run()
+			)
+
+		self.party_names = {}
+		for party_type, name_field in self.party_name_fields.items():
+			party = frappe.qb.DocType(party_type)
+			parties = apply_export_filters(
+				frappe.qb.from_(gle).select(gle.party).distinct().where(gle.party_type == party_type),
+				gle, *export_filters
+			)
+			self.party_names[party_type] = dict(
+				frappe.qb.from_(party)
+				.select(party.name, party[name_field])
+				.where(party.name.isin(parties))
+				.run()
+			)
+
+	def get_title(self, voucher_type, voucher_no):
+		return self.titles.get(voucher_type, {}).get(voucher_no)
+
+	def get_party(self, party_type, party):
+		party_names = self.party_names.get(party_type, {})
+		if party not in party_names:
+			return None, None
+
+		return party, party_names[party]
+
+
+class FECFormatter:
+	"""Turn GL Entry rows of the FEC query into FEC lines"""
+
+	def __init__(self, company, lettrage, labels):
+		self.company_currency = frappe.get_cached_value("Company", company, "default_currency")
+		self.accounts = {
+			account.name: account
+			for account in frappe.get_all(
+				"Account",
+				filters={"company": company, "account_number": ("is", "set")},
+				fields=["name", "account_number", "account_name"],
+			)
+		}
+		self.journals = {
+			j.journal_code: j.journal_name
+			for j in frappe.get_all("Accounting Journal", fields=["journal_code", "journal_name"])
+		}
+		self.lettrage = lettrage
+		self.labels = labels
+
+		# Translated once, as rows may be formatted while an unbuffered cursor is open
+		self.opening_entry_label = _("Opening Entry Journal")
+		self.no_remarks_labels = ("no remarks", _("no remarks"))
+
+	def format_row(self, d):
+		JournalCode = d.get("accounting_journal") or re.split("-|/|[0-9]", d.get("voucher_no"))[0]
+		EcritureNum = d.get("accounting_entry_number")
+		GlName = d.get("GlName")
+
+		EcritureDate = format_datetime(d.get("GlPostDate"), "yyyyMMdd")
+		ExportDate = format_datetime(d.get("ExportDate"), "yyyy-MM-dd HH:mm")
+
+		account = self.accounts.get(d.get("account"))
+		if account:
+			CompteNum = account.account_number
+		else:
+			frappe.throw(
+				_(
+					"Account number for account {0} is not available.<br> Please setup your Chart of Accounts correctly."
+				).format(d.get("account"))
+			)
+
+		if d.get("party_type") in self.labels.party_name_fields:
+			CompAuxNum, CompAuxLib = self.labels.get_party(d.get("party_type"), d.get("party"))
+		else:
+			CompAuxNum = ""
+			CompAuxLib = ""
+
+		ValidDate = format_datetime(d.get("GlPostDate"), "yyyyMMdd")
+
+		PieceRef = d.get("voucher_no") or "Sans Reference"
+
+		# EcritureLib is the reference title unless it is an opening entry
+		if d.get("is_opening") == "Yes":
+			EcritureLib = self.opening_entry_label
+		elif d.get("remarks") and d.get("remarks").lower() not in self.no_remarks_labels:
+			EcritureLib = d.get("remarks")
+		elif d.get("voucher_type") in self.labels.title_doctypes:
+			EcritureLib = self.labels.get_title(d.get("voucher_type"), d.get("voucher_no"))
+		else:
+			EcritureLib = d.get("voucher_type")
+
+		EcritureLib = " ".join(EcritureLib.splitlines())
+
+		debit = "{:.2f}".format(d.get("debit")).replace(".", ",")
+
+		credit = "{:.2f}".format(d.get("credit")).replace(".", ",")
+
+		if d.debit == d.credit == 0:
+			return None
+
+		Idevise = d.get("account_currency")
+
+		DateLet = self.lettrage.get_date_let(d) if d.get("against_voucher") else None
+		EcritureLet = d.get("against_voucher", "") if DateLet else ""
+
+		Montantdevise = None
+		if Idevise != self.company_currency:
+			Montantdevise = (
+				"{:.2f}".format(d.get("debitCurr")).replace(".", ",")
+				if d.get("debitCurr") != 0
+				else "{:.2f}".format(d.get("creditCurr")).replace(".", ",")
+			)
+		else:
+			Montantdevise = (
+				"{:.2f}".format(d.get("debit")).replace(".", ",")
+				if d.get("debit") != 0
+				else "{:.2f}".format(d.get("credit")).replace(".", ",")
+			)
+
+		return [
+			JournalCode,
+			self.journals.get(JournalCode),
+			EcritureNum,
+			EcritureDate,
+			CompteNum,
+			d.get("account"),
+			CompAuxNum,
+			CompAuxLib,
+			PieceRef,
+			EcritureLib,
+			debit,
+			credit,
+			EcritureLet,
+			DateLet or "",
+			ValidDate,
+			Montantdevise,
+			Idevise,
+			ExportDate,
+			GlName
+		]
+
+
+def iter_fec_rows(
+	company, fiscal_year, from_date, to_date, hide_already_exported, partition=None, chunk_size=CHUNK_SIZE
+):
+	"""
+	Yield the FEC lines by chunks, reading GL Entries from a server-side cursor
+
+	`partition` restricts the lines to a (from_date, to_date) part of the export.
+	No query can be run while the cursor is open, so everything the formatter needs
+	is loaded beforehand and the consumer must not query the database between chunks.
+	"""
+	partition_from_date, partition_to_date = partition or (from_date, to_date)
+	formatter = FECFormatter(
+		company,
+		LettrageResolver(company, fiscal_year, from_date, to_date, hide_already_exported, partition),
+		FECLabels(company, fiscal_year, partition_from_date, partition_to_date, hide_already_exported),
+	)
+	query = get_gl_entries_query(
+		company, fiscal_year, partition_from_date, partition_to_date, hide_already_exported
+	)
+
+	with frappe.db.unbuffered_cursor():
+		entries = query.run(as_dict=True, as_iterator=True)
+		while chunk := list(islice(entries, chunk_size)):
+			yield [row for row in map(formatter.format_row, chunk) if row]
+
+
+def iter_unexported_fec_rows(company, fiscal_year, from_date, to_date, export_date, chunk_size=CHUNK_SIZE):
+	"""
+	Yield the FEC lines of the entries not exported yet by chunks, and stamp their export date
+
+	Each chunk is the first not exported entries in the FEC order, so that stamping a
+	chunk moves the next query to the following one. The stamps are not committed, the
+	caller's transaction keeps the file and the export dates consistent.
+	"""
+	formatter = FECFormatter(
+		company,
+		LettrageResolver(company, fiscal_year, from_date, to_date, True),
+		FECLabels(company, fiscal_year, from_date, to_date, True),
+	)
+	query = get_gl_entries_query(company, fiscal_year, from_date, to_date, True).limit(chunk_size)
+
+	while chunk := query.run(as_dict=True):
+		yield [row for row in map(formatter.format_row, chunk) if row]
+		set_export_date([d.GlName for d in chunk], export_date)
+
+
+def set_export_date(gl_entries, export_date):
+	gle = frappe.qb.DocType("GL Entry")
+	frappe.qb.update(gle).set(gle.export_date, export_date).where(gle.name.isin(gl_entries)).run()
+
+
+def count_fec_lines(company, fiscal_year, from_date, to_date, hide_already_exported):
+	gle = frappe.qb.DocType("GL Entry")
+	return apply_export_filters(
+		frappe.qb.from_(gle).select(Count(gle.name)).where((gle.debit != 0) | (gle.credit != 0)),
+		gle, company, fiscal_year, from_date, to_date, hide_already_exported
+	).run()[0][0]
+
+
+def get_month_partitions(from_date, to_date):
+	"""Split the period in (from_date, to_date) calendar months"""
+	partitions = []
+	start, end = getdate(from_date), getdate(to_date)
+	while start <= end:
+		partitions.append((start, min(get_last_day(start), end)))
+		start = add_days(get_last_day(start), 1)
+
+	return partitions
+
+
+def get_fec_file_name(company, fiscal_year):
+	siren_number = frappe.db.get_value("Company", company, "siren_number")
+	if not siren_number:
+		frappe.throw(_("Please register the SIREN number in the company information file"))
+
+	year_end_date = frappe.db.get_value("Fiscal Year", fiscal_year, "year_end_date")
+	return "{0}FEC{1}.txt".format(siren_number, format_datetime(year_end_date, "yyyyMMdd"))
+
+
+def get_fec_file_path(file_name):
+	"""Return a free path in the private files folder for the FEC file"""
+	path = frappe.get_site_path("private", "files", file_name)
+	while os.path.exists(path):
+		name, extension = os.path.splitext(file_name)
+		path = frappe.get_site_path(
+			"private", "files", "{0}-{1}{2}".format(name, frappe.generate_hash(length=6), extension)
+		)
+
+	return path
+
+
+def format_fec_line(row):
+	return FEC_SEPARATOR.join(
+		str(value if value is not None else "").replace(FEC_SEPARATOR, " ")
+		for value in row[:len(FEC_FIELDS)]
+	)
+
+
+def write_fec_lines(fec_file, rows):
+	fec_file.writelines(format_fec_line(row) + "\r\n" for row in rows)
+
+
+def attach_fec_file(path, file_name, attached_to_doctype, attached_to_name):
+	file_doc = frappe.get_doc({
+		"doctype": "File",
+		"file_name": file_name,
+		"file_url": "/private/files/" + os.path.basename(path),
+		"attached_to_doctype": attached_to_doctype,
+		"attached_to_name": attached_to_name,
+		"is_private": 1,
+	})
+	file_doc.insert(ignore_permissions=True)
+
+	return file_doc
+
+
+@frappe.whitelist()
+def export_fec_file(
+	company, fiscal_year, from_date=None, to_date=None, hide_already_exported=0, mark_as_exported=0
+):
+	"""
+	Write the FEC of the fiscal year in a pipe-delimited file attached to the company
+
+	With `mark_as_exported`, only the entries not exported yet are written and stamped.
+	"""
+	frappe.has_permission("GL Entry", "export", throw=True)
+
+	year_start_date, year_end_date = frappe.db.get_value(
+		"Fiscal Year", fiscal_year, ["year_start_date", "year_end_date"]
+	)
+	from_date = getdate(from_date or year_start_date)
+	to_date = getdate(to_date or year_end_date)
+
+	if cint(mark_as_exported):
+		fec_rows = iter_unexported_fec_rows(company, fiscal_year, from_date, to_date, now_datetime())
+	else:
+		fec_rows = iter_fec_rows(company, fiscal_year, from_date, to_date, cint(hide_already_exported))
+
+	file_name = get_fec_file_name(company, fiscal_year)
+	path = get_fec_file_path(file_name)
+
+	with open(path, "w", encoding="utf-8", newline="") as fec_file:
+		fec_file.write(FEC_SEPARATOR.join(FEC_FIELDS) + "\r\n")
+		for rows in fec_rows:
+			write_fec_lines(fec_file, rows)
+
+	file_doc = attach_fec_file(path, file_name, "Company", company)
+
+	return {"name": file_doc.name, "file_url": file_doc.file_url}
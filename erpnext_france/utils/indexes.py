@@ -0,0 +1,87 @@
+# Copyright (c) 2024, Scopen and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe import _
+from frappe.utils import getdate
+
+from erpnext_france.utils.fec import apply_export_filters, get_gl_entries_query
+
+# (doctype, fields, index_name) of the composite indexes used by the FEC, the accounting exports
+# and the opening balances
+INDEXES = (
+	(
+		"GL Entry",
+		["company", "fiscal_year", "posting_date", "voucher_no", "accounting_entry_number"],
+		"fec_export_index",
+	),
+	(
+		"GL Entry",
+		["company", "fiscal_year", "export_date", "posting_date", "voucher_no", "accounting_entry_number"],
+		"fec_unexported_index",
+	),
+	(
+		"GL Entry",
+		["against_voucher", "against_voucher_type", "party"],
+		"fec_lettrage_index",
+	),
+	(
+		"GL Entry",
+		["voucher_type", "posting_date"],
+		"accounting_export_index",
+	),
+	(
+		"Account Balance Snapshot",
+		["company", "account", "month"],
+		"balance_snapshot_index",
+	),
+)
+
+
+def add_indexes():
+	for doctype, fields, index_name in INDEXES:
+		frappe.db.add_index(doctype, fields, index_name=index_name)
+
+
+def check_query_plans(company, fiscal_year, accounting_document="Sales Invoice"):
+	"""
+	Return and log the FEC and accounting export queries reading a table without an index
+
+	Run with `bench --site <site> execute erpnext_france.utils.indexes.check_query_plans
+	--kwargs "{'company': '<company>', 'fiscal_year': '<fiscal year>'}"`
+	"""
+	from erpnext_france.erpnext_france.doctype.accounting_export.exporter import DataExporter
+
+	from_date, to_date = frappe.db.get_value(
+		"Fiscal Year", fiscal_year, ["year_start_date", "year_end_date"]
+	)
+	export_args = (company, fiscal_year, getdate(from_date), getdate(to_date))
+
+	gle = frappe.qb.DocType("GL Entry")
+	queries = {
+		"FEC": get_gl_entries_query(*export_args, False),
+		"FEC not exported": get_gl_entries_query(*export_args, True),
+		"Mark as exported": apply_export_filters(
+			frappe.qb.from_(gle).select(gle.name), gle, *export_args, True
+		),
+		"Accounting Export": DataExporter(
+			company=company,
+			accounting_document=accounting_document,
+			from_date=from_date,
+			to_date=to_date,
+		).get_query(),
+	}
+
+	full_scans = []
+	for label, query in queries.items():
+		for step in frappe.db.sql("EXPLAIN {0}".format(query.get_sql()), as_dict=True):
+			if step.type == "ALL":
+				full_scans.append(
+					_("{0}: full scan of {1} ({2} rows)").format(label, step.table, step.rows)
+				)
+
+	logger = frappe.logger("erpnext_france")
+	for message in full_scans:
+		logger.warning(message)
+
+	return full_scans
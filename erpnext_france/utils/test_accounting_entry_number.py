@@ -0,0 +1,95 @@
+# Copyright (c) 2024, Scopen and Contributors
+# See license.txt
+
+import frappe
+from erpnext.accounts.doctype.sales_invoice.test_sales_invoice import create_sales_invoice
+from frappe.query_builder.functions import Min
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import cint
+
+from erpnext_france.utils.accounting_entry_number import backfill_vouchers
+
+
+class TestAccountingEntryNumber(FrappeTestCase):
+	def get_series_prefix(self, si):
+		fiscal_year = frappe.db.get_value("GL Entry", {"voucher_no": si.name}, "fiscal_year")
+		return "AEN-{0}-".format(fiscal_year)
+
+	def get_series_current(self, prefix):
+		return cint(frappe.db.get_value("Series", prefix, "current"))
+
+	def get_numbers(self, si):
+		return set(
+			frappe.get_all("GL Entry", filters={"voucher_no": si.name}, pluck="accounting_entry_number")
+		)
+
+	def run_before_commit(self):
+		"""Number the pending vouchers as a commit would, leaving the test transaction open"""
+		frappe.db.before_commit.run()
+
+	def test_number_before_commit(self):
+		si = create_sales_invoice()
+		self.assertFalse(any(self.get_numbers(si)))
+
+		self.run_before_commit()
+
+		prefix = self.get_series_prefix(si)
+		self.assertEqual(
+			self.get_numbers(si), {"{0}{1:09d}".format(prefix, self.get_series_current(prefix))}
+		)
+
+	def test_gap_free_across_rollback(self):
+		rolled_back = create_sales_invoice()
+		prefix = self.get_series_prefix(rolled_back)
+		frappe.db.rollback()
+		self.assertFalse(frappe.db.exists("GL Entry", {"voucher_no": rolled_back.name}))
+		self.assertFalse(getattr(frappe.local, "pending_accounting_vouchers", None))
+		current = self.get_series_current(prefix)
+
+		first = create_sales_invoice()
+		frappe.db.savepoint("rolled_back_voucher")
+		create_sales_invoice()
+		frappe.db.rollback(save_point="rolled_back_voucher")
+		second = create_sales_invoice()
+		self.run_before_commit()
+
+		self.assertEqual(self.get_series_current(prefix), current + 2)
+		self.assertEqual(self.get_numbers(first), {"{0}{1:09d}".format(prefix, current + 1)})
+		self.assertEqual(self.get_numbers(second), {"{0}{1:09d}".format(prefix, current + 2)})
+
+	def test_backfill_partly_numbered_voucher(self):
+		si = create_sales_invoice()
+		self.run_before_commit()
+		(accounting_entry_number,) = self.get_numbers(si)
+
+		gle = frappe.qb.DocType("GL Entry")
+		(
+			frappe.qb.update(gle)
+			.set(gle.accounting_journal, "_Test Journal")
+			.where(gle.voucher_no == si.name)
+		).run()
+
+		# One line of the voucher lost its number and journal
+		gl_entries = frappe.get_all("GL Entry", filters={"voucher_no": si.name}, pluck="name")
+		(
+			frappe.qb.update(gle)
+			.set(gle.accounting_entry_number, None)
+			.set(gle.accounting_journal, "")
+			.where(gle.name == gl_entries[0])
+		).run()
+
+		vouchers = (
+			frappe.qb.from_(gle)
+			.select(gle.posting_date, gle.voucher_no, gle.voucher_type, Min(gle.name).as_("gl_entry"))
+			.where(gle.voucher_no == si.name)
+			.groupby(gle.posting_date, gle.voucher_no, gle.voucher_type)
+		).run(as_dict=True)
+		current = self.get_series_current(self.get_series_prefix(si))
+
+		self.assertEqual(backfill_vouchers(vouchers), 0)
+		self.assertEqual(self.get_numbers(si), {accounting_entry_number})
+		self.assertEqual(
+			set(frappe.get_all("GL Entry", filters={"voucher_no": si.name}, pluck="accounting_journal")),
+			{"_Test Journal"},
+		)
+		self.assertEqual(self.get_series_current(self.get_series_prefix(si)), current)